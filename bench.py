@@ -0,0 +1,337 @@
+"""Микробенчмарки и нагрузочные тесты горячих путей бота.
+
+Запуск:
+    python bench.py handler [--messages 20000] [--users 2000]
+    python bench.py broadcast [--users 10000] [--latency-ms 5] [--retry-after-rate 0.001] [--error-rate 0.01]
+                              [--server-error-rate 0.01] [--digest]
+    python bench.py suite [--sizes 1000 10000 100000]
+    python bench.py corpus [--json quotes_1000.json] [--synthetic 1000000]
+
+broadcast прогоняет daily_prediction_job против локальной заглушки Bot API (fake_telegram_api.py,
+запускается отдельным процессом), лимиты отправки по умолчанию сняты — меряется сам бот.
+suite запускает handler и broadcast для каждого размера в отдельном процессе и сводит
+в таблицу время, сообщ./с, пиковый RSS и задержку цикла событий.
+"""
+import argparse
+import asyncio
+import contextlib
+import datetime
+import os
+import json
+import random
+import re
+import resource
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+BENCH_CHAT_ID = -1001234567890
+FAKE_API_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_telegram_api.py")
+
+# bot.py читает настройки из окружения при импорте.
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:bench")
+os.environ.setdefault("TARGET_CHANNEL_ID", str(BENCH_CHAT_ID))
+os.environ.setdefault("USERS_DB_FILE", os.path.join(tempfile.mkdtemp(prefix="predictor-bench-"), "users.db"))
+os.environ.setdefault("IMPORT_USERS_JSON", "0")
+# Предупреждения о каждой неудачной отправке заглушили бы результаты.
+os.environ.setdefault("LOG_LEVEL", "ERROR")
+
+import telegram
+from telegram import Chat, Message, Update, User
+from telegram.request import HTTPXRequest
+
+import bot
+import corpus
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def format_latencies(name, latencies):
+    latencies = sorted(latencies)
+    return (f"{name}: n={len(latencies)} "
+            f"p50={percentile(latencies, 0.50) * 1e6:.1f} мкс "
+            f"p95={percentile(latencies, 0.95) * 1e6:.1f} мкс "
+            f"p99={percentile(latencies, 0.99) * 1e6:.1f} мкс "
+            f"max={latencies[-1] * 1e6:.1f} мкс "
+            f"mean={statistics.fmean(latencies) * 1e6:.1f} мкс")
+
+
+def make_update(update_id, user_id, rename=False):
+    chat = Chat(id=BENCH_CHAT_ID, type=Chat.SUPERGROUP)
+    user = User(
+        id=user_id, is_bot=False,
+        first_name=f"User{user_id}" + ("_renamed" if rename else ""),
+        username=f"user_{user_id}"
+    )
+    message = Message(
+        message_id=update_id, date=datetime.datetime.now(datetime.timezone.utc),
+        chat=chat, from_user=user, text="Всем привет!"
+    )
+    return Update(update_id=update_id, message=message)
+
+
+class LoopLagMonitor:
+    """Задержка цикла событий: насколько позже запланированного просыпается asyncio.sleep(interval)."""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.lags = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, time.perf_counter() - started - self.interval))
+
+    async def __aenter__(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+
+    def summary(self) -> dict:
+        lags = sorted(self.lags) or [0.0]
+        return {"loop_lag_p99_ms": percentile(lags, 0.99) * 1000, "loop_lag_max_ms": lags[-1] * 1000}
+
+
+async def bench_handler(messages, users):
+    """Прогоняет store_user_from_channel_message на синтетических апдейтах.
+
+    Примерно 5% сообщений меняют профиль автора, чтобы в выборку попали и записи в базу.
+    Апдейты создаются по одному: на 100k пользователей заранее собранный список занял бы сотни МБ.
+    """
+    rng = random.Random(42)
+    latencies = []
+    async with LoopLagMonitor() as lag:
+        started = time.perf_counter()
+        for i in range(messages):
+            update = make_update(i, rng.randint(1, users), rename=rng.random() < 0.05)
+            t0 = time.perf_counter()
+            await bot.store_user_from_channel_message(update, None)
+            latencies.append(time.perf_counter() - t0)
+            # PTB обрабатывает каждый апдейт отдельной задачей, между ними цикл событий свободен.
+            await asyncio.sleep(0)
+        wall = time.perf_counter() - started
+    await bot.flush_known_users()
+    print(format_latencies("store_user_from_channel_message", latencies))
+    return {
+        "bench": "handler", "users": users, "messages": messages, "wall_s": wall,
+        "msgs_per_s": messages / sum(latencies), "peak_rss_mb": peak_rss_mb(), **lag.summary(),
+        "known_users": len(bot.known_users_data), "flushes": bot.user_flush_stats['flushes'],
+    }
+
+
+def start_fake_api(args):
+    """Запускает fake_telegram_api.py на свободном порту; возвращает (процесс, порт)."""
+    process = subprocess.Popen([
+        sys.executable, FAKE_API_SCRIPT, "--port", "0", "--seed", "1",
+        "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms),
+        "--retry-after-rate", str(args.retry_after_rate), "--retry-after", str(args.retry_after),
+        "--error-rate", str(args.error_rate), "--server-error-rate", str(args.server_error_rate),
+    ], stdout=subprocess.PIPE, text=True)
+    match = re.search(r":(\d+)/bot", process.stdout.readline())
+    if not match:
+        process.kill()
+        raise RuntimeError("fake_telegram_api.py не сообщил порт")
+    return process, int(match.group(1))
+
+
+def stop_fake_api(process) -> dict:
+    process.send_signal(signal.SIGINT)
+    output = process.communicate(timeout=10)[0].strip()
+    return json.loads(output.splitlines()[-1]) if output else {}
+
+
+async def bench_broadcast(args):
+    """Рассылка через daily_prediction_job всем `args.users` участникам канала."""
+    bot.load_channels()
+    bot.load_known_users()
+    channel = bot.channels[BENCH_CHAT_ID]
+    channel.digest = args.digest
+    for user_id in range(1, args.users + 1):
+        bot.known_users_data[user_id] = {
+            "id": user_id, "first_name": f"User{user_id}", "last_name": None,
+            "username": f"user_{user_id}" if user_id % 3 else None,
+        }
+        channel.members.add(user_id)
+    # В корпусе 1000 предсказаний, а пользователей больше: разрешаем повторы между пользователями в один день.
+    bot.PREDICTION_GLOBAL_WINDOW_DAYS = 0
+    bot.broadcast_scheduler = bot.BroadcastScheduler(
+        args.rate, args.chat_rate_per_minute, args.concurrency, retry_backoff=args.retry_backoff
+    )
+
+    process, port = start_fake_api(args)
+    try:
+        tg_bot = telegram.Bot(
+            bot.TELEGRAM_BOT_TOKEN, base_url=f"http://127.0.0.1:{port}/bot",
+            request=HTTPXRequest(connection_pool_size=args.concurrency + 4)
+        )
+        context = types.SimpleNamespace(bot=tg_bot, job=types.SimpleNamespace(data=channel.chat_id))
+        async with tg_bot:
+            async with LoopLagMonitor() as lag:
+                started = time.perf_counter()
+                await bot.daily_prediction_job(context)
+                wall = time.perf_counter() - started
+    finally:
+        api_stats = stop_fake_api(process)
+    sent = bot.MESSAGES_SENT.values.get((str(channel.chat_id),), 0)
+    return {
+        "bench": "broadcast", "users": args.users, "messages": sent, "wall_s": wall,
+        "msgs_per_s": sent / wall if wall > 0 else 0.0, "peak_rss_mb": peak_rss_mb(), **lag.summary(),
+        "api_429": api_stats.get("sendMessage:429", 0),
+        "api_errors": api_stats.get("sendMessage:400", 0) + api_stats.get("sendMessage:403", 0),
+        "api_502": api_stats.get("sendMessage:502", 0),
+        "members_left": len(channel.members),
+    }
+
+
+def format_result(result):
+    return (f"{result['bench']}: пользователей {result['users']}, сообщений {result['messages']}, "
+            f"время {result['wall_s']:.2f} с, {result['msgs_per_s']:.0f} сообщ./с, "
+            f"пиковый RSS {result['peak_rss_mb']:.1f} МБ, задержка цикла событий "
+            f"p99 {result['loop_lag_p99_ms']:.2f} мс / max {result['loop_lag_max_ms']:.2f} мс")
+
+
+def run_suite(args):
+    """Каждый замер — в отдельном процессе, чтобы пиковый RSS и состояние бота не смешивались."""
+    for size in args.sizes:
+        commands = (
+            ["handler", "--users", str(size), "--messages", str(max(size, 20000))],
+            ["broadcast", "--users", str(size), "--latency-ms", str(args.latency_ms),
+             "--retry-after-rate", str(args.retry_after_rate), "--error-rate", str(args.error_rate),
+             "--server-error-rate", str(args.server_error_rate),
+             "--concurrency", str(args.concurrency)],
+        )
+        for command in commands:
+            output = subprocess.run(
+                [sys.executable, __file__, *command, "--json"],
+                check=True, capture_output=True, text=True
+            ).stdout
+            print(format_result(json.loads(output.strip().splitlines()[-1])), flush=True)
+
+
+def proc_status_mb(field):
+    """Поле из /proc/self/status в МБ. ru_maxrss не подходит: в Linux он наследуется через exec от родителя."""
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def rss_mb():
+    return proc_status_mb("VmRSS")
+
+
+def peak_rss_mb():
+    return proc_status_mb("VmHWM")
+
+
+def measure_corpus_load(path, lookups=1000):
+    """Запускается в отдельном процессе: время загрузки корпуса и прирост RSS."""
+    rss_before = rss_mb()
+    started = time.perf_counter()
+    predictions = bot.load_predictions_from_file(path)
+    load_time = time.perf_counter() - started
+    rng = random.Random(1)
+    started = time.perf_counter()
+    for _ in range(lookups):
+        predictions[rng.randrange(len(predictions))]['text']
+    lookup_time = (time.perf_counter() - started) / lookups
+    print(json.dumps({
+        "count": len(predictions), "load_s": load_time,
+        "rss_mb": rss_mb() - rss_before, "lookup_us": lookup_time * 1e6
+    }))
+
+
+def bench_corpus(json_path, synthetic):
+    workdir = tempfile.mkdtemp(prefix="predictor-corpus-")
+    if synthetic:
+        json_path = os.path.join(workdir, "synthetic.json")
+        rng = random.Random(7)
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump([
+                {"id": i + 1, "text": f"Предсказание №{i + 1}: " + "звёзды благосклонны " * rng.randint(2, 8)}
+                for i in range(synthetic)
+            ], f, ensure_ascii=False)
+    bin_path = os.path.join(workdir, "corpus.bin")
+    corpus.convert_json(json_path, bin_path)
+    print(f"Корпус: {json_path} ({os.path.getsize(json_path) / 2**20:.1f} МБ), "
+          f"PRDC: {os.path.getsize(bin_path) / 2**20:.1f} МБ")
+    for label, path in (("json", json_path), ("mmap", bin_path)):
+        output = subprocess.run(
+            [sys.executable, __file__, "corpus-load", path],
+            check=True, capture_output=True, text=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"{label}: {result['count']} записей, загрузка {result['load_s'] * 1000:.1f} мс, "
+              f"прирост RSS {result['rss_mb']:.1f} МБ, доступ по индексу {result['lookup_us']:.1f} мкс")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    handler_parser = subparsers.add_parser("handler", help="задержка обработчика сообщений канала")
+    handler_parser.add_argument("--messages", type=int, default=20000)
+    handler_parser.add_argument("--users", type=int, default=2000)
+    handler_parser.add_argument("--json", action="store_true", help="напечатать итог строкой JSON")
+    broadcast_parser = subparsers.add_parser("broadcast", help="рассылка через заглушку Bot API")
+    broadcast_parser.add_argument("--users", type=int, default=10000)
+    broadcast_parser.add_argument("--rate", type=float, default=1e6, help="общий лимит, сообщ./с")
+    broadcast_parser.add_argument("--chat-rate-per-minute", type=float, default=1e9)
+    broadcast_parser.add_argument("--concurrency", type=int, default=32)
+    broadcast_parser.add_argument("--digest", action="store_true", help="режим дайджеста")
+    broadcast_parser.add_argument("--retry-backoff", type=float, default=0.1, help="первая пауза перед повтором, с")
+    broadcast_parser.add_argument("--json", action="store_true", help="напечатать итог строкой JSON")
+    suite_parser = subparsers.add_parser("suite", help="handler и broadcast на нескольких размерах базы")
+    suite_parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    suite_parser.add_argument("--concurrency", type=int, default=32)
+    for sub in (broadcast_parser, suite_parser):
+        sub.add_argument("--latency-ms", type=float, default=5.0, help="задержка ответа заглушки")
+        sub.add_argument("--jitter-ms", type=float, default=0.0)
+        sub.add_argument("--retry-after-rate", type=float, default=0.0, help="доля ответов 429")
+        sub.add_argument("--retry-after", type=int, default=1)
+        sub.add_argument("--error-rate", type=float, default=0.0, help="доля постоянных ошибок (403/400)")
+        sub.add_argument("--server-error-rate", type=float, default=0.0, help="доля временных ошибок (502)")
+    corpus_parser = subparsers.add_parser("corpus", help="время загрузки и RSS для JSON и mmap-корпуса")
+    corpus_parser.add_argument("--json", default="quotes_1000.json")
+    corpus_parser.add_argument("--synthetic", type=int, default=0, help="сгенерировать корпус из N записей")
+    load_parser = subparsers.add_parser("corpus-load")
+    load_parser.add_argument("path")
+    args = parser.parse_args()
+
+    if args.command == "handler":
+        bot.load_channels()
+        bot.load_known_users()
+        result = asyncio.run(bench_handler(args.messages, args.users))
+        print(json.dumps(result) if args.json else format_result(result))
+    elif args.command == "broadcast":
+        result = asyncio.run(bench_broadcast(args))
+        print(json.dumps(result) if args.json else format_result(result))
+    elif args.command == "suite":
+        run_suite(args)
+    elif args.command == "corpus":
+        bench_corpus(args.json, args.synthetic)
+    elif args.command == "corpus-load":
+        measure_corpus_load(args.path)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,248 +1,1374 @@
 import telegram
-from telegram import Update
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.constants import ParseMode
-from telegram.ext import Application, CommandHandler, CallbackContext, MessageHandler, filters
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler, CallbackContext, MessageHandler, filters
 import os
+import html
+import bisect
 import json
+import math
 import random
+import sqlite3
 import asyncio
+import collections
+import concurrent.futures
 import datetime
+import functools
+import logging
+import sys
+import time
 import pytz 
 from dotenv import load_dotenv
 
+from corpus import MappedCorpus
+from metrics import Counter, Histogram, start_metrics_server
+
 # Загрузка переменных окружения
 load_dotenv()
 
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# text — строки для человека, json — по объекту на строку для сборщика логов.
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_SAMPLE_EVERY_STR = os.getenv("LOG_SAMPLE_EVERY", "100")
+LOG_SAMPLE_EVERY = int(LOG_SAMPLE_EVERY_STR) if LOG_SAMPLE_EVERY_STR.isdigit() and int(LOG_SAMPLE_EVERY_STR) > 0 else 100
+
+_STANDARD_LOG_FIELDS = set(logging.makeLogRecord({}).__dict__) | {"message", "asctime", "sample"}
+
+class JsonLogFormatter(logging.Formatter):
+    """Запись лога одной JSON-строкой; поля из `extra` становятся полями объекта."""
+
+    def format(self, record):
+        payload = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _STANDARD_LOG_FIELDS:
+                payload[key] = value
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+class SamplingFilter(logging.Filter):
+    """Пропускает только каждую N-ю запись, помеченную extra={"sample": True}; счётчик — на шаблон сообщения."""
+
+    def __init__(self, every: int):
+        super().__init__()
+        self.every = every
+        self.counters = collections.Counter()
+
+    def filter(self, record):
+        if not getattr(record, "sample", False):
+            return True
+        seen = self.counters[record.msg]
+        self.counters[record.msg] = seen + 1
+        return seen % self.every == 0
+
+def setup_logging():
+    handler = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == "json":
+        handler.setFormatter(JsonLogFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    handler.addFilter(SamplingFilter(LOG_SAMPLE_EVERY))
+    level = logging.getLevelName(LOG_LEVEL)
+    logging.basicConfig(level=level if isinstance(level, int) else logging.INFO, handlers=[handler], force=True)
+    # httpx пишет каждый запрос к Bot API на уровне INFO.
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+setup_logging()
+logger = logging.getLogger("predictor_bot")
+
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 TARGET_CHANNEL_ID_STR = os.getenv("TARGET_CHANNEL_ID")
+# JSON-файл со списком каналов; если не задан, используется один канал из TARGET_CHANNEL_ID.
+CHANNELS_FILE = os.getenv("CHANNELS_FILE")
 ADMIN_USER_ID_STR = os.getenv("ADMIN_USER_ID")
 SCHEDULE_HOUR_STR = os.getenv("SCHEDULE_HOUR", "22")
 SCHEDULE_MINUTE_STR = os.getenv("SCHEDULE_MINUTE", "0")
+BROADCAST_RATE_STR = os.getenv("BROADCAST_RATE", "25")
+CHAT_RATE_PER_MINUTE_STR = os.getenv("CHAT_RATE_PER_MINUTE", "20")
+BROADCAST_CONCURRENCY_STR = os.getenv("BROADCAST_CONCURRENCY", "4")
+# Режим вебхука включается заданием WEBHOOK_URL (публичный https-адрес бота); иначе — polling.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT_STR = os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN")
+UPDATE_CONCURRENCY_STR = os.getenv("UPDATE_CONCURRENCY", "16")
+# Порт локального HTTP-эндпоинта /metrics (формат Prometheus); пусто — эндпоинт выключен.
+METRICS_PORT_STR = os.getenv("METRICS_PORT", "")
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+# Адрес Bot API вида http://host:port/bot (токен дописывается в конец); для нагрузочных тестов с fake_telegram_api.py.
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL")
 
 # --- Начальная диагностика переменных окружения ---
-print("--- Начало диагностики переменных окружения ---")
-print(f"TELEGRAM_BOT_TOKEN: {'Задан' if TELEGRAM_BOT_TOKEN else 'НЕ ЗАДАН'}")
-print(f"TARGET_CHANNEL_ID_STR: {TARGET_CHANNEL_ID_STR if TARGET_CHANNEL_ID_STR else 'НЕ ЗАДАН'}")
-print(f"ADMIN_USER_ID_STR: {ADMIN_USER_ID_STR if ADMIN_USER_ID_STR else 'НЕ ЗАДАН'}")
-print(f"SCHEDULE_HOUR_STR: {SCHEDULE_HOUR_STR}")
-print(f"SCHEDULE_MINUTE_STR: {SCHEDULE_MINUTE_STR}")
-print("--- Конец диагностики переменных окружения ---")
+logger.info(
+    "Переменные окружения: TELEGRAM_BOT_TOKEN=%s TARGET_CHANNEL_ID=%s CHANNELS_FILE=%s ADMIN_USER_ID=%s "
+    "SCHEDULE=%s:%s BROADCAST_RATE=%s CHAT_RATE_PER_MINUTE=%s BROADCAST_CONCURRENCY=%s "
+    "WEBHOOK_URL=%s WEBHOOK_PORT=%s WEBHOOK_SECRET_TOKEN=%s UPDATE_CONCURRENCY=%s METRICS_PORT=%s "
+    "TELEGRAM_API_BASE_URL=%s",
+    'Задан' if TELEGRAM_BOT_TOKEN else 'НЕ ЗАДАН',
+    TARGET_CHANNEL_ID_STR or 'НЕ ЗАДАН',
+    CHANNELS_FILE or 'НЕ ЗАДАН',
+    ADMIN_USER_ID_STR or 'НЕ ЗАДАН',
+    SCHEDULE_HOUR_STR, SCHEDULE_MINUTE_STR,
+    BROADCAST_RATE_STR, CHAT_RATE_PER_MINUTE_STR, BROADCAST_CONCURRENCY_STR,
+    WEBHOOK_URL or 'НЕ ЗАДАН (режим polling)', WEBHOOK_PORT_STR,
+    'Задан' if WEBHOOK_SECRET_TOKEN else 'НЕ ЗАДАН',
+    UPDATE_CONCURRENCY_STR, METRICS_PORT_STR or 'НЕ ЗАДАН',
+    TELEGRAM_API_BASE_URL or 'по умолчанию'
+)
 
 
 if not TELEGRAM_BOT_TOKEN:
-    print("ОШИБКА: Переменная окружения TELEGRAM_BOT_TOKEN не установлена!")
-if not TARGET_CHANNEL_ID_STR:
-    print("ОШИБКА: Переменная окружения TARGET_CHANNEL_ID не установлена!")
+    logger.error("Переменная окружения TELEGRAM_BOT_TOKEN не установлена!")
+if not TARGET_CHANNEL_ID_STR and not CHANNELS_FILE:
+    logger.error("Не установлена ни переменная окружения TARGET_CHANNEL_ID, ни CHANNELS_FILE!")
 
 TARGET_CHANNEL_ID = None
 if TARGET_CHANNEL_ID_STR:
     try:
         TARGET_CHANNEL_ID = int(TARGET_CHANNEL_ID_STR)
     except ValueError:
-        print(f"ОШИБКА: TARGET_CHANNEL_ID ('{TARGET_CHANNEL_ID_STR}') должен быть числом!")
+        logger.error("TARGET_CHANNEL_ID (%r) должен быть числом!", TARGET_CHANNEL_ID_STR)
 
 ADMIN_USER_ID = int(ADMIN_USER_ID_STR) if ADMIN_USER_ID_STR and ADMIN_USER_ID_STR.isdigit() else None
 SCHEDULE_HOUR = int(SCHEDULE_HOUR_STR) if SCHEDULE_HOUR_STR and SCHEDULE_HOUR_STR.isdigit() else 22
 SCHEDULE_MINUTE = int(SCHEDULE_MINUTE_STR) if SCHEDULE_MINUTE_STR and SCHEDULE_MINUTE_STR.isdigit() else 0
 
-all_predictions = []
+def parse_positive_float(value_str, default):
+    try:
+        value = float(value_str)
+    except (TypeError, ValueError):
+        return default
+    return value if value > 0 else default
+
+# Лимиты Telegram: ~30 сообщений в секунду на бота и ~20 сообщений в минуту в одну группу/канал.
+BROADCAST_RATE = parse_positive_float(BROADCAST_RATE_STR, 25.0)
+CHAT_RATE_PER_MINUTE = parse_positive_float(CHAT_RATE_PER_MINUTE_STR, 20.0)
+BROADCAST_CONCURRENCY = int(BROADCAST_CONCURRENCY_STR) if BROADCAST_CONCURRENCY_STR and BROADCAST_CONCURRENCY_STR.isdigit() and int(BROADCAST_CONCURRENCY_STR) > 0 else 4
+WEBHOOK_PORT = int(WEBHOOK_PORT_STR) if WEBHOOK_PORT_STR.isdigit() else 8443
+# Сколько апдейтов обрабатывать одновременно (и в режиме polling, и в режиме вебхука).
+UPDATE_CONCURRENCY = int(UPDATE_CONCURRENCY_STR) if UPDATE_CONCURRENCY_STR.isdigit() and int(UPDATE_CONCURRENCY_STR) > 0 else 16
+METRICS_PORT = int(METRICS_PORT_STR) if METRICS_PORT_STR.isdigit() else None
+
+SEND_LATENCY = Histogram(
+    "predictor_send_latency_seconds", "Длительность запроса sendMessage при рассылке", ["channel"]
+)
+SEND_ERRORS = Counter(
+    "predictor_send_errors_total", "Ошибки отправки предсказаний по классу исключения", ["channel", "error"]
+)
+MESSAGES_SENT = Counter("predictor_messages_sent_total", "Успешно отправленные сообщения с предсказаниями", ["channel"])
+HANDLER_LATENCY = Histogram(
+    "predictor_handler_latency_seconds", "Время обработки апдейта обработчиком", ["handler"],
+    buckets=(0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+)
+BROADCAST_DURATION = Histogram(
+    "predictor_broadcast_duration_seconds", "Длительность рассылки канала", ["channel"]
+)
+USERS_FLUSH_LATENCY = Histogram(
+    "predictor_users_flush_seconds", "Длительность записи пачки изменений пользователей в базу",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+)
+
+def timed_handler(handler):
+    """Учитывает время работы обработчика апдейтов в HANDLER_LATENCY."""
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await handler(update, context)
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, handler=name)
+    return wrapper
+
+channels = {}
+predictions_by_file = {}
 known_users_data = {}
-predictions_sent_today_ids = set()
+# user_id -> готовое упоминание в HTML (format_mention); сбрасывается при смене профиля.
+mention_cache = {}
+dirty_user_ids = set()
+dirty_members = set()
+user_flush_stats = {"last_latency": 0.0, "last_batch": 0, "flushes": 0, "records": 0}
+users_flush_lock = asyncio.Lock()
+early_flush_task = None
+store_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="user-store")
 USERS_DATA_FILE = "known_users.json"
+# JSON-массив или компактный корпус .bin (см. corpus.py).
+PREDICTIONS_FILE = os.getenv("PREDICTIONS_FILE", "quotes_1000.json")
+USERS_DB_FILE = os.getenv("USERS_DB_FILE", "known_users.db")
+# Однократный импорт старого known_users.json в базу при первом запуске.
+IMPORT_USERS_JSON = os.getenv("IMPORT_USERS_JSON", "1") != "0"
+# Не повторять предсказание пользователю N дней и не выдавать одно предсказание разным людям N дней.
+PREDICTION_USER_WINDOW_DAYS_STR = os.getenv("PREDICTION_USER_WINDOW_DAYS", "30")
+PREDICTION_GLOBAL_WINDOW_DAYS_STR = os.getenv("PREDICTION_GLOBAL_WINDOW_DAYS", "1")
+PREDICTION_USER_WINDOW_DAYS = int(PREDICTION_USER_WINDOW_DAYS_STR) if PREDICTION_USER_WINDOW_DAYS_STR.isdigit() else 30
+PREDICTION_GLOBAL_WINDOW_DAYS = int(PREDICTION_GLOBAL_WINDOW_DAYS_STR) if PREDICTION_GLOBAL_WINDOW_DAYS_STR.isdigit() else 1
+USERS_FLUSH_INTERVAL_STR = os.getenv("USERS_FLUSH_INTERVAL", "5")
+USERS_FLUSH_INTERVAL = parse_positive_float(USERS_FLUSH_INTERVAL_STR, 5.0)
+# Сколько изменённых пользователей накапливать, прежде чем сбросить их досрочно, не дожидаясь таймера.
+USERS_FLUSH_BATCH_SIZE_STR = os.getenv("USERS_FLUSH_BATCH_SIZE", "500")
+USERS_FLUSH_BATCH_SIZE = int(USERS_FLUSH_BATCH_SIZE_STR) if USERS_FLUSH_BATCH_SIZE_STR.isdigit() and int(USERS_FLUSH_BATCH_SIZE_STR) > 0 else 500
+# Время последнего сообщения пользователя (для /stats) обновляется не чаще раза в столько секунд,
+# чтобы активный пользователь не попадал в запись в базу с каждым сообщением.
+LAST_SEEN_RESOLUTION = 3600
+LIST_USERS_PAGE_SIZE = 25
+# Режим дайджеста: предсказания многих пользователей упаковываются в несколько сообщений вместо одного на человека.
+# Значение по умолчанию для каналов; в CHANNELS_FILE его переопределяет поле "digest".
+DIGEST_MODE = os.getenv("DIGEST_MODE", "0") == "1"
+# Telegram разбирает не более 100 сущностей (упоминаний, ссылок) в сообщении, остальные становятся простым текстом.
+DIGEST_MAX_MENTIONS_STR = os.getenv("DIGEST_MAX_MENTIONS", "50")
+DIGEST_MAX_MENTIONS = int(DIGEST_MAX_MENTIONS_STR) if DIGEST_MAX_MENTIONS_STR.isdigit() and 0 < int(DIGEST_MAX_MENTIONS_STR) <= 100 else 50
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Временные ошибки отправки (таймауты, сеть) повторяются раундами с паузой SEND_RETRY_BACKOFF, 2x, 4x... секунд.
+SEND_RETRY_ATTEMPTS_STR = os.getenv("SEND_RETRY_ATTEMPTS", "3")
+SEND_RETRY_ATTEMPTS = int(SEND_RETRY_ATTEMPTS_STR) if SEND_RETRY_ATTEMPTS_STR.isdigit() and int(SEND_RETRY_ATTEMPTS_STR) > 0 else 3
+SEND_RETRY_BACKOFF = parse_positive_float(os.getenv("SEND_RETRY_BACKOFF", "2"), 2.0)
+DIGEST_HEADER = "Предсказания на сегодня:\n\n"
 
-def load_predictions_from_file(filename="quotes_1000.json"):
-    global all_predictions
+def load_predictions_from_file(filename=None):
+    """Загружает корпус предсказаний: JSON-массив целиком или файл .bin (corpus.py) через mmap.
+
+    Каналы с одним и тем же файлом делят один загруженный корпус.
+    """
+    filename = filename or PREDICTIONS_FILE
+    if filename in predictions_by_file:
+        return predictions_by_file[filename]
+    predictions = []
     try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            all_predictions = json.load(f)
-        print(f"Загружено {len(all_predictions)} предсказаний из {filename}.")
+        if filename.endswith(".bin"):
+            predictions = MappedCorpus(filename)
+        else:
+            with open(filename, 'r', encoding='utf-8') as f:
+                predictions = json.load(f)
+        logger.info("Загружено %d предсказаний из %s.", len(predictions), filename)
     except FileNotFoundError:
-        print(f"Файл предсказаний {filename} не найден. Предсказания не будут отправляться.")
-        all_predictions = []
+        logger.error("Файл предсказаний %s не найден. Предсказания не будут отправляться.", filename)
     except json.JSONDecodeError:
-        print(f"Ошибка декодирования JSON в файле {filename}. Проверьте его структуру.")
-        all_predictions = []
+        logger.error("Ошибка декодирования JSON в файле %s. Проверьте его структуру.", filename)
+    except ValueError as e:
+        logger.error("Ошибка чтения корпуса предсказаний %s: %s", filename, e)
+    predictions_by_file[filename] = predictions
+    return predictions
 
-def save_known_users():
-    global known_users_data
-    try:
-        with open(USERS_DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(known_users_data, f, ensure_ascii=False, indent=4)
-        print(f"Данные пользователей сохранены в {USERS_DATA_FILE} ({len(known_users_data)} пользователей)")
-    except Exception as e:
-        print(f"Ошибка сохранения данных пользователей в {USERS_DATA_FILE}: {e}")
+class Channel:
+    """Чат, в который бот рассылает предсказания: свои участники, расписание, часовой пояс и корпус."""
+
+    def __init__(self, chat_id: int, name: str = None, schedule_hour: int = 22, schedule_minute: int = 0,
+                 timezone: str = "Europe/Moscow", predictions_file: str = None, digest: bool = None):
+        self.chat_id = chat_id
+        self.name = name or str(chat_id)
+        self.schedule_hour = schedule_hour
+        self.schedule_minute = schedule_minute
+        self.timezone = pytz.timezone(timezone)
+        self.predictions_file = predictions_file or PREDICTIONS_FILE
+        self.digest = DIGEST_MODE if digest is None else digest
+        self.predictions = []
+        self.members = set()
+        # Одна рассылка канала одновременно: плановая задача, /force_send и возобновление ждут друг друга.
+        self.broadcast_lock = asyncio.Lock()
+
+    def schedule_text(self) -> str:
+        return f"{self.schedule_hour:02d}:{self.schedule_minute:02d} ({self.timezone.zone})"
+
+def load_channels():
+    """Заполняет `channels` из CHANNELS_FILE или, если он не задан, из TARGET_CHANNEL_ID/SCHEDULE_*.
+
+    Формат CHANNELS_FILE — JSON-массив объектов:
+    {"chat_id": -100..., "name": "...", "schedule_hour": 22, "schedule_minute": 0,
+     "timezone": "Europe/Moscow", "predictions_file": "quotes_1000.json", "digest": false}
+    """
+    channels.clear()
+    if CHANNELS_FILE:
+        try:
+            with open(CHANNELS_FILE, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.error("Не удалось прочитать список каналов %s: %s", CHANNELS_FILE, e)
+            entries = []
+        for entry in entries:
+            try:
+                channel = Channel(
+                    int(entry['chat_id']), entry.get('name'),
+                    int(entry.get('schedule_hour', SCHEDULE_HOUR)), int(entry.get('schedule_minute', SCHEDULE_MINUTE)),
+                    entry.get('timezone', "Europe/Moscow"), entry.get('predictions_file'), entry.get('digest')
+                )
+                if not isinstance(channel.digest, bool):
+                    raise TypeError(f"digest должен быть true или false, а не {entry.get('digest')!r}")
+            except (KeyError, TypeError, ValueError, pytz.UnknownTimeZoneError) as e:
+                logger.error("Некорректное описание канала в %s: %r (%r)", CHANNELS_FILE, entry, e)
+                continue
+            channels[channel.chat_id] = channel
+    elif TARGET_CHANNEL_ID:
+        channels[TARGET_CHANNEL_ID] = Channel(TARGET_CHANNEL_ID, None, SCHEDULE_HOUR, SCHEDULE_MINUTE)
+
+    for channel in channels.values():
+        channel.predictions = load_predictions_from_file(channel.predictions_file)
+    logger.info("Настроено каналов: %d", len(channels))
+
+class UserStore:
+    """Хранилище пользователей в SQLite (режим WAL).
+
+    Добавление/обновление и удаление пользователя — одна операция по первичному ключу,
+    без перезаписи всего файла.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        # Запись идёт из отдельного потока store_executor (один поток, операции последовательны).
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            "id INTEGER PRIMARY KEY, first_name TEXT, last_name TEXT, username TEXT)"
+        )
+        user_columns = [row[1] for row in self.conn.execute("PRAGMA table_info(users)")]
+        if 'last_seen' not in user_columns:
+            self.conn.execute("ALTER TABLE users ADD COLUMN last_seen REAL")
+        # Поиск по началу username в /list_users (без учёта регистра), в порядке (username, id).
+        self.conn.execute("CREATE INDEX IF NOT EXISTS users_username ON users (username COLLATE NOCASE)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS channel_members ("
+            "chat_id INTEGER NOT NULL, user_id INTEGER NOT NULL, PRIMARY KEY (chat_id, user_id))"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS prediction_history ("
+            "day INTEGER NOT NULL, user_id INTEGER NOT NULL, prediction_id INTEGER NOT NULL, chat_id INTEGER)"
+        )
+        history_columns = [row[1] for row in self.conn.execute("PRAGMA table_info(prediction_history)")]
+        if 'chat_id' not in history_columns:
+            self.conn.execute("ALTER TABLE prediction_history ADD COLUMN chat_id INTEGER")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS prediction_history_day ON prediction_history (day)")
+        # Рассылка канала за день (run_id = "<chat_id>:<day>") и план доставки по пользователям.
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS broadcast_runs ("
+            "run_id TEXT PRIMARY KEY, chat_id INTEGER NOT NULL, day INTEGER NOT NULL, "
+            "status TEXT NOT NULL, started_at REAL, finished_at REAL)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS deliveries ("
+            "chat_id INTEGER NOT NULL, day INTEGER NOT NULL, user_id INTEGER NOT NULL, "
+            "prediction_id INTEGER NOT NULL, prediction_index INTEGER NOT NULL, status TEXT NOT NULL, "
+            "PRIMARY KEY (chat_id, day, user_id))"
+        )
+        # Журнал удалений из рассылки (надгробия) после постоянных ошибок отправки.
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS member_removals ("
+            "chat_id INTEGER NOT NULL, user_id INTEGER NOT NULL, reason TEXT, removed_at REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS member_removals_chat ON member_removals (chat_id, removed_at)")
+        self.conn.commit()
+
+    def apply_batch(self, upserts: list, deletes: list, member_adds: list = (), member_removes: list = ()):
+        """Записывает пачку изменений одной транзакцией.
+
+        member_adds/member_removes — пары (chat_id, user_id) участия в каналах.
+        """
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO channel_members (chat_id, user_id) VALUES (?, ?)", member_adds)
+            self.conn.executemany("DELETE FROM channel_members WHERE chat_id = ? AND user_id = ?", member_removes)
+            self.conn.executemany(
+                "INSERT INTO users (id, first_name, last_name, username, last_seen) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET first_name = excluded.first_name, "
+                "last_name = excluded.last_name, username = excluded.username, last_seen = excluded.last_seen",
+                [(info['id'], info.get('first_name'), info.get('last_name'), info.get('username'), info.get('last_seen'))
+                 for info in upserts]
+            )
+            self.conn.executemany("DELETE FROM users WHERE id = ?", [(user_id,) for user_id in deletes])
+
+    def load_all(self) -> dict:
+        rows = self.conn.execute("SELECT id, first_name, last_name, username, last_seen FROM users")
+        return {
+            row[0]: {"id": row[0], "first_name": row[1], "last_name": row[2], "username": row[3], "last_seen": row[4]}
+            for row in rows
+        }
+
+    def load_members(self) -> dict:
+        members = {}
+        for chat_id, user_id in self.conn.execute("SELECT chat_id, user_id FROM channel_members"):
+            members.setdefault(chat_id, set()).add(user_id)
+        return members
+
+    def migrate_members(self, chat_id: int):
+        """Однократно записывает всех пользователей из базы одного канала в участники `chat_id`."""
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO channel_members (chat_id, user_id) SELECT ?, id FROM users", (chat_id,)
+            )
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('members_migrated', ?)", (str(chat_id),))
+
+    def get_meta(self, key: str):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def load_allocator(self, chat_id: int, since_day: int):
+        """Состояние аллокатора предсказаний канала и история выдачи начиная с дня `since_day`."""
+        state = self.get_meta(f'prediction_allocator:{chat_id}')
+        history = self.conn.execute(
+            "SELECT day, user_id, prediction_id FROM prediction_history WHERE chat_id = ? AND day >= ?",
+            (chat_id, since_day)
+        ).fetchall()
+        return (json.loads(state) if state else None), history
+
+    def load_run(self, chat_id: int, day: int):
+        """Статус рассылки канала за день (или None) и её план: [(user_id, prediction_id, prediction_index, status)]."""
+        row = self.conn.execute(
+            "SELECT status FROM broadcast_runs WHERE run_id = ?", (broadcast_run_id(chat_id, day),)
+        ).fetchone()
+        deliveries = self.conn.execute(
+            "SELECT user_id, prediction_id, prediction_index, status FROM deliveries WHERE chat_id = ? AND day = ?",
+            (chat_id, day)
+        ).fetchall()
+        return (row[0] if row else None), deliveries
+
+    def save_plan(self, chat_id: int, day: int, allocator_state: dict, rows: list):
+        """Атомарно сохраняет новые строки плана и курсор аллокатора, помечая рассылку как незавершённую."""
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO broadcast_runs (run_id, chat_id, day, status, started_at) VALUES (?, ?, ?, 'running', ?) "
+                "ON CONFLICT(run_id) DO UPDATE SET status = 'running', finished_at = NULL",
+                (broadcast_run_id(chat_id, day), chat_id, day, time.time())
+            )
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO deliveries (chat_id, day, user_id, prediction_id, prediction_index, status) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(chat_id, day) + tuple(row) for row in rows]
+            )
+            self.conn.execute(
+                "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (f'prediction_allocator:{chat_id}', json.dumps(allocator_state))
+            )
+
+    def set_delivery_status(self, chat_id: int, day: int, user_ids: list, status: str):
+        """Отмечает доставку пользователям `user_ids` (в режиме дайджеста — всем из одного сообщения)."""
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE deliveries SET status = ? WHERE chat_id = ? AND day = ? AND user_id = ?",
+                [(status, chat_id, day, user_id) for user_id in user_ids]
+            )
+
+    def finish_run(self, chat_id: int, day: int, prune_before_day: int):
+        """Закрывает рассылку: доставленное попадает в историю выдачи, старые записи удаляются."""
+        with self.conn:
+            self.conn.execute(
+                "UPDATE broadcast_runs SET status = 'done', finished_at = ? WHERE run_id = ?",
+                (time.time(), broadcast_run_id(chat_id, day))
+            )
+            self.conn.execute("DELETE FROM prediction_history WHERE chat_id = ? AND day = ?", (chat_id, day))
+            self.conn.execute(
+                "INSERT INTO prediction_history (day, user_id, prediction_id, chat_id) "
+                "SELECT day, user_id, prediction_id, chat_id FROM deliveries "
+                "WHERE chat_id = ? AND day = ? AND status IN ('sending', 'sent')",
+                (chat_id, day)
+            )
+            for table in ("prediction_history", "deliveries", "broadcast_runs"):
+                self.conn.execute(f"DELETE FROM {table} WHERE chat_id = ? AND day < ?", (chat_id, prune_before_day))
+
+    def apply_tombstones(self, chat_id: int, tombstones: list):
+        """Одной транзакцией удаляет пользователей [(user_id, reason)] из участников канала и пишет их в журнал."""
+        removed_at = time.time()
+        with self.conn:
+            self.conn.executemany(
+                "DELETE FROM channel_members WHERE chat_id = ? AND user_id = ?",
+                [(chat_id, user_id) for user_id, _ in tombstones]
+            )
+            self.conn.executemany(
+                "INSERT INTO member_removals (chat_id, user_id, reason, removed_at) VALUES (?, ?, ?, ?)",
+                [(chat_id, user_id, reason, removed_at) for user_id, reason in tombstones]
+            )
+
+    def members_page(self, chat_id: int, cursor: int, backward: bool, prefix: str, user_id: int, limit: int,
+                     count: bool = False):
+        """Страница участников канала: ([(user_id, first_name, last_name, username)], число найденных или None).
+
+        Keyset-пагинация: страница начинается после участника `cursor` (при backward — заканчивается
+        перед ним), поэтому каждая страница читает из индекса только свои строки.
+        Без фильтра порядок — по user_id (первичный ключ channel_members); user_id — поиск по точному id;
+        prefix — поиск по началу username в порядке индекса users_username, членство в канале
+        проверяется по первичному ключу. Найденные считаются только при count=True (первая страница
+        поиска): без фильтра их число известно по channel.members, а позицию страницы передаёт вызывающий код.
+        """
+        columns = "m.user_id, u.first_name, u.last_name, u.username"
+        if not prefix:
+            source = "channel_members m LEFT JOIN users u ON u.id = m.user_id"
+            where, params = "m.chat_id = ?", [chat_id]
+            if user_id is not None:
+                where += " AND m.user_id = ?"
+                params.append(user_id)
+            total = None
+            if count:
+                total = self.conn.execute(f"SELECT COUNT(*) FROM {source} WHERE {where}", params).fetchone()[0]
+            if backward:
+                rows = self.conn.execute(
+                    f"SELECT {columns} FROM {source} WHERE {where} AND m.user_id < ? ORDER BY m.user_id DESC LIMIT ?",
+                    params + [cursor, limit]
+                ).fetchall()[::-1]
+            else:
+                rows = self.conn.execute(
+                    f"SELECT {columns} FROM {source} WHERE {where} AND m.user_id > ? ORDER BY m.user_id LIMIT ?",
+                    params + [cursor, limit]
+                ).fetchall()
+            return rows, total
+
+        # CROSS JOIN закрепляет порядок: сначала диапазон индекса по username, затем поиск в channel_members.
+        source = "users u CROSS JOIN channel_members m ON m.chat_id = ? AND m.user_id = u.id"
+        low, high = prefix, prefix + "\uffff"
+        total = None
+        if count:
+            total = self.conn.execute(
+                f"SELECT COUNT(*) FROM {source} WHERE u.username >= ? COLLATE NOCASE AND u.username < ? COLLATE NOCASE",
+                (chat_id, low, high)
+            ).fetchone()[0]
+        # Курсор — user_id последней показанной строки; граница диапазона — его username.
+        row = self.conn.execute("SELECT username FROM users WHERE id = ?", (cursor,)).fetchone() if cursor else None
+        cursor_name = row[0] if row and row[0] else None
+        order = "u.username COLLATE NOCASE{0}, u.id{0}"
+        if backward and cursor_name is not None:
+            rows = self.conn.execute(
+                f"SELECT {columns} FROM {source} WHERE u.username >= ? COLLATE NOCASE AND u.username <= ? COLLATE NOCASE "
+                f"AND (u.username < ? COLLATE NOCASE OR u.id < ?) ORDER BY {order.format(' DESC')} LIMIT ?",
+                (chat_id, low, cursor_name, cursor_name, cursor, limit)
+            ).fetchall()[::-1]
+        elif cursor_name is not None:
+            rows = self.conn.execute(
+                f"SELECT {columns} FROM {source} WHERE u.username >= ? COLLATE NOCASE AND u.username < ? COLLATE NOCASE "
+                f"AND (u.username > ? COLLATE NOCASE OR u.id > ?) ORDER BY {order.format('')} LIMIT ?",
+                (chat_id, cursor_name, high, cursor_name, cursor, limit)
+            ).fetchall()
+        else:
+            # Первая страница, либо участник-курсор с тех пор удалён — начинаем с начала.
+            rows = self.conn.execute(
+                f"SELECT {columns} FROM {source} WHERE u.username >= ? COLLATE NOCASE AND u.username < ? COLLATE NOCASE "
+                f"ORDER BY {order.format('')} LIMIT ?",
+                (chat_id, low, high, limit)
+            ).fetchall()
+        return rows, total
+
+    def channel_stats(self, chat_id: int, now: float) -> dict:
+        """Участники канала по давности последнего сообщения и удаления из рассылки (member_removals)."""
+        day = 86400
+        last_seen = dict(self.conn.execute(
+            "SELECT CASE WHEN u.last_seen IS NULL THEN 'unknown' WHEN u.last_seen >= ? THEN 'day' "
+            "WHEN u.last_seen >= ? THEN 'week' WHEN u.last_seen >= ? THEN 'month' ELSE 'older' END, COUNT(*) "
+            "FROM channel_members m LEFT JOIN users u ON u.id = m.user_id WHERE m.chat_id = ? GROUP BY 1",
+            (now - day, now - 7 * day, now - 30 * day, chat_id)
+        ).fetchall())
+        removals = self.conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(removed_at >= ?), 0), COALESCE(SUM(removed_at >= ?), 0) "
+            "FROM member_removals WHERE chat_id = ?",
+            (now - day, now - 7 * day, chat_id)
+        ).fetchone()
+        reasons = self.conn.execute(
+            "SELECT reason, COUNT(*) FROM member_removals WHERE chat_id = ? AND removed_at >= ? "
+            "GROUP BY reason ORDER BY COUNT(*) DESC LIMIT 3",
+            (chat_id, now - 30 * day)
+        ).fetchall()
+        return {"last_seen": last_seen, "removals": removals, "reasons": reasons}
+
+    def pending_deliveries(self, chat_id: int, day: int) -> list:
+        """Пользователи, которым рассылка за день ещё должна отправить сообщение."""
+        return [row[0] for row in self.conn.execute(
+            "SELECT user_id FROM deliveries WHERE chat_id = ? AND day = ? AND status = 'pending'", (chat_id, day)
+        )]
+
+    def unfinished_runs(self) -> list:
+        return self.conn.execute("SELECT chat_id, day FROM broadcast_runs WHERE status = 'running'").fetchall()
+
+    def import_json(self, filename: str) -> int:
+        """Однократный импорт пользователей из старого known_users.json."""
+        with open(filename, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        rows = [
+            (int(k), v.get('first_name'), v.get('last_name'), v.get('username'))
+            for k, v in data.items()
+        ]
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO users (id, first_name, last_name, username) VALUES (?, ?, ?, ?)", rows
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('json_imported_from', ?)", (filename,)
+            )
+        return len(rows)
+
+user_store = None
+
+def open_user_store() -> UserStore:
+    global user_store
+    if user_store is None:
+        user_store = UserStore(USERS_DB_FILE)
+        if IMPORT_USERS_JSON and os.path.exists(USERS_DATA_FILE) and user_store.get_meta('json_imported_from') is None:
+            try:
+                imported = user_store.import_json(USERS_DATA_FILE)
+                logger.info("Импортировано %d пользователей из %s в %s", imported, USERS_DATA_FILE, USERS_DB_FILE)
+            except (json.JSONDecodeError, ValueError, AttributeError) as e:
+                logger.error("Не удалось импортировать пользователей из %s: %s", USERS_DATA_FILE, e)
+        # До поддержки нескольких каналов все пользователи относились к TARGET_CHANNEL_ID.
+        legacy_chat_id = TARGET_CHANNEL_ID or next(iter(channels), None)
+        if legacy_chat_id is not None and user_store.get_meta('members_migrated') is None:
+            user_store.migrate_members(legacy_chat_id)
+    return user_store
 
 def load_known_users():
     global known_users_data
-    if not os.path.exists(USERS_DATA_FILE):
-        print(f"Файл {USERS_DATA_FILE} не найден. Начинаем с пустого списка пользователей.")
-        known_users_data = {}
-        return
     try:
-        with open(USERS_DATA_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            known_users_data = {int(k): v for k, v in data.items()}
-        print(f"Загружено {len(known_users_data)} пользователей из {USERS_DATA_FILE}")
-    except json.JSONDecodeError:
-        print(f"Ошибка декодирования JSON в {USERS_DATA_FILE}. Начинаем с пустого списка.")
-        known_users_data = {}
-    except Exception as e:
-        print(f"Не удалось загрузить данные пользователей из {USERS_DATA_FILE}: {e}")
+        store = open_user_store()
+        known_users_data = store.load_all()
+        members = store.load_members()
+        logger.info("Загружено %d пользователей из %s", len(known_users_data), USERS_DB_FILE)
+    except sqlite3.Error as e:
+        logger.error("Не удалось загрузить данные пользователей из %s: %s", USERS_DB_FILE, e)
         known_users_data = {}
+        members = {}
+    mention_cache.clear()
+    for chat_id, channel in channels.items():
+        channel.members = {user_id for user_id in members.get(chat_id, ()) if user_id in known_users_data}
+        logger.info("Канал %s: %d участников", channel.name, len(channel.members))
+
+def mark_user_dirty(user_id: int):
+    """Помечает пользователя для записи в базу при следующем сбросе (flush_known_users).
+
+    known_users_data в памяти — единственный источник истины; база догоняет его пачками.
+    Повторные изменения одного пользователя до сброса схлопываются в одну запись.
+    """
+    dirty_user_ids.add(user_id)
+    schedule_early_flush()
+
+def mark_member_dirty(chat_id: int, user_id: int):
+    """Как mark_user_dirty, но для участия пользователя в канале (channel.members)."""
+    dirty_members.add((chat_id, user_id))
+    schedule_early_flush()
+
+def schedule_early_flush():
+    global early_flush_task
+    if len(dirty_user_ids) + len(dirty_members) >= USERS_FLUSH_BATCH_SIZE and \
+       (early_flush_task is None or early_flush_task.done()):
+        try:
+            early_flush_task = asyncio.get_running_loop().create_task(flush_known_users())
+        except RuntimeError:
+            pass  # нет запущенного цикла событий — данные сбросит ближайший flush_users_job
+
+async def flush_known_users():
+    """Записывает накопленные изменения в базу в потоке store_executor, не блокируя цикл событий."""
+    async with users_flush_lock:
+        if not dirty_user_ids and not dirty_members:
+            return
+        batch = list(dirty_user_ids)
+        member_batch = list(dirty_members)
+        dirty_user_ids.clear()
+        dirty_members.clear()
+        # Копии снимаются в цикле событий, чтобы поток записи не видел изменения "на лету".
+        upserts = [dict(known_users_data[user_id]) for user_id in batch if user_id in known_users_data]
+        deletes = [user_id for user_id in batch if user_id not in known_users_data]
+        member_adds, member_removes = [], []
+        for chat_id, user_id in member_batch:
+            if chat_id in channels and user_id in channels[chat_id].members:
+                member_adds.append((chat_id, user_id))
+            else:
+                member_removes.append((chat_id, user_id))
+        started = time.monotonic()
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                store_executor, open_user_store().apply_batch, upserts, deletes, member_adds, member_removes
+            )
+        except sqlite3.Error as e:
+            dirty_user_ids.update(batch)
+            dirty_members.update(member_batch)
+            logger.error("Ошибка записи %d изменений в %s, повторим при следующем сбросе: %s",
+                         len(batch) + len(member_batch), USERS_DB_FILE, e)
+            return
+        user_flush_stats["last_latency"] = time.monotonic() - started
+        USERS_FLUSH_LATENCY.observe(user_flush_stats["last_latency"])
+        user_flush_stats["last_batch"] = len(batch) + len(member_batch)
+        user_flush_stats["flushes"] += 1
+        user_flush_stats["records"] += len(batch) + len(member_batch)
+        logger.debug("Сохранено изменений пользователей: %d обновлений, %d удалений, участие в каналах: +%d/-%d за %.1f мс",
+                     len(upserts), len(deletes), len(member_adds), len(member_removes),
+                     user_flush_stats['last_latency'] * 1000)
+
+async def flush_users_job(context: CallbackContext):
+    await flush_known_users()
+
+class PredictionAllocator:
+    """Раздаёт предсказания за O(1) на пользователя по сохраняемой перестановке корпуса.
+
+    Перестановка индексов задаётся как i -> (a * i + b) mod n (a взаимно просто с n), поэтому
+    хранить нужно только (n, a, b, cursor) — без списка на весь корпус. Когда курсор проходит
+    весь корпус, начинается новая эпоха с новыми a и b.
+
+    Кандидат отклоняется, если пользователь получал это предсказание за последние
+    `user_window` дней или его кто-то получал за последние `global_window` дней.
+    Отклонённые кандидаты откладываются и предлагаются следующим пользователям.
+    """
+
+    MAX_CANDIDATES = 64
+
+    def __init__(self, size: int, state: dict, history: list, today: int,
+                 user_window: int, global_window: int, prediction_id_at):
+        self.size = size
+        self.today = today
+        self.user_window = user_window
+        self.global_window = global_window
+        self.prediction_id_at = prediction_id_at
+        self.rng = random.Random()
+        if state and state.get('n') == size:
+            self.state = state
+        else:
+            self.state = {'n': size, 'epoch': (state or {}).get('epoch', 0), 'a': 1, 'b': 0, 'cursor': size}
+        self.user_recent = {}
+        self.last_used = {}
+        for day, user_id, prediction_id in history:
+            if day > today - user_window:
+                self.user_recent.setdefault(user_id, set()).add(prediction_id)
+            if day > self.last_used.get(prediction_id, -1):
+                self.last_used[prediction_id] = day
+        self.deferred = collections.deque()
+
+    def _next_index(self) -> int:
+        state = self.state
+        if state['cursor'] >= state['n']:
+            n = state['n']
+            # Шаг около n / φ разносит соседние выдачи по всему корпусу.
+            a = max(1, int(n * 0.618) + self.rng.randrange(max(1, n // 20)))
+            while math.gcd(a, n) != 1:
+                a += 1
+            state.update(epoch=state['epoch'] + 1, a=a, b=self.rng.randrange(n), cursor=0)
+        index = (state['a'] * state['cursor'] + state['b']) % state['n']
+        state['cursor'] += 1
+        return index
+
+    def _usable(self, user_id: int, prediction_id: int) -> bool:
+        if self.last_used.get(prediction_id, -1) > self.today - self.global_window:
+            return False
+        return prediction_id not in self.user_recent.get(user_id, ())
+
+    def allocate(self, user_id: int):
+        """Возвращает индекс предсказания для пользователя или None, если подходящих не осталось."""
+        if not self.size:
+            return None
+        for _ in range(len(self.deferred)):
+            index = self.deferred.popleft()
+            prediction_id = self.prediction_id_at(index)
+            if self._usable(user_id, prediction_id):
+                self.last_used[prediction_id] = self.today
+                return index
+            if self.last_used.get(prediction_id, -1) <= self.today - self.global_window:
+                self.deferred.append(index)
+        for _ in range(min(self.MAX_CANDIDATES, self.size)):
+            index = self._next_index()
+            prediction_id = self.prediction_id_at(index)
+            if self._usable(user_id, prediction_id):
+                self.last_used[prediction_id] = self.today
+                return index
+            if len(self.deferred) < self.MAX_CANDIDATES and \
+               self.last_used.get(prediction_id, -1) <= self.today - self.global_window:
+                self.deferred.append(index)
+        return None
+
+    def mark_used(self, prediction_id: int):
+        """Учитывает предсказание, уже выданное сегодня (например, по ранее сохранённому плану)."""
+        self.last_used[prediction_id] = self.today
+
+async def load_prediction_allocator(channel: Channel, today: int) -> PredictionAllocator:
+    store = open_user_store()
+    since_day = today - max(PREDICTION_USER_WINDOW_DAYS, PREDICTION_GLOBAL_WINDOW_DAYS)
+    state, history = await asyncio.get_running_loop().run_in_executor(
+        store_executor, store.load_allocator, channel.chat_id, since_day
+    )
+    predictions = channel.predictions
+    return PredictionAllocator(
+        len(predictions), state, history, today,
+        PREDICTION_USER_WINDOW_DAYS, PREDICTION_GLOBAL_WINDOW_DAYS,
+        lambda index: predictions[index]['id']
+    )
+
+def broadcast_run_id(chat_id: int, day: int) -> str:
+    return f"{chat_id}:{day}"
+
+def find_prediction(channel: Channel, prediction_id: int, index_hint: int):
+    """Предсказание из плана рассылки; если корпус с тех пор изменился, ищет его по id."""
+    predictions = channel.predictions
+    if 0 <= index_hint < len(predictions) and predictions[index_hint]['id'] == prediction_id:
+        return predictions[index_hint]
+    if isinstance(predictions, MappedCorpus):
+        return predictions.get_by_id(prediction_id)
+    return next((prediction for prediction in predictions if prediction['id'] == prediction_id), None)
+
+def retry_after_seconds(error: telegram.error.RetryAfter) -> float:
+    retry_after = error.retry_after
+    if isinstance(retry_after, datetime.timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+# Исход одной отправки в рассылке.
+SEND_OK = "sent"
+SEND_TRANSIENT = "transient"  # таймаут или сетевая ошибка — отправку стоит повторить
+SEND_PERMANENT = "permanent"  # ошибка касается пользователя — он удаляется из рассылки
+SEND_CHANNEL = "channel"      # ошибка касается канала (нет прав, бот удалён) — рассылка останавливается
+SEND_ERROR = "error"          # прочие ошибки (в т.ч. текст сообщения) — без повтора и без удаления пользователя
+
+# Сообщения идут в канал, а не пользователю, поэтому Forbidden/BadRequest обычно говорят о канале
+# или о тексте сообщения. Удалять пользователя можно только по описаниям, которые называют его самого.
+USER_SEND_ERRORS = (
+    "user not found", "chat member not found", "user is deactivated", "user restricted",
+    "bot was blocked by the user",
+)
+CHANNEL_SEND_ERRORS = (
+    "chat not found", "bot was kicked", "bot is not a member", "group chat was deactivated",
+    "no rights", "not enough rights", "administrator rights", "chat_write_forbidden", "chat_admin_required",
+)
+
+def classify_send_error(error: Exception) -> str:
+    """Категория ошибки отправки по классу исключения telegram.error и описанию ошибки.
+
+    RetryAfter сюда не попадает — паузу и повтор выполняет BroadcastScheduler.submit.
+    BadRequest и TimedOut — подклассы NetworkError, поэтому BadRequest проверяется первым.
+    """
+    if isinstance(error, telegram.error.ChatMigrated):
+        return SEND_CHANNEL
+    if isinstance(error, (telegram.error.Forbidden, telegram.error.BadRequest)):
+        description = str(error).lower()
+        if any(marker in description for marker in USER_SEND_ERRORS):
+            return SEND_PERMANENT
+        if isinstance(error, telegram.error.Forbidden) or any(marker in description for marker in CHANNEL_SEND_ERRORS):
+            return SEND_CHANNEL
+        return SEND_ERROR
+    if isinstance(error, telegram.error.NetworkError):
+        return SEND_TRANSIENT
+    return SEND_ERROR
+
+class TokenBucket:
+    """Токен-бакет: в среднем не более `rate` отправок в секунду, всплеск до `capacity`."""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Останавливает выдачу токенов (например, после RetryAfter от Telegram)."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.updated = self.paused_until
+        self.tokens = 0.0
+
+    async def acquire(self):
+        # Лок сохраняет порядок ожидающих (FIFO), поэтому ни одна отправка не "голодает".
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class BroadcastScheduler:
+    """Планировщик отправок: общий лимит бота + отдельная "полоса" (бакет) на каждый чат.
+
+    RetryAfter приостанавливает только полосу того чата, для которого он пришёл.
+    Рассылки нескольких каналов идут одновременно и делят общий бакет: его лок выдаёт токены
+    ожидающим по очереди, поэтому каждый канал с одинаковым числом воркеров получает равную долю.
+    Отправки с временной ошибкой (SEND_TRANSIENT) собираются в очередь повтора и повторяются
+    раундами после паузы retry_backoff, 2 * retry_backoff, ... — не более max_attempts попыток.
+    Ошибка канала (SEND_CHANNEL) останавливает рассылку: остальные отправки не выполняются.
+    """
+
+    def __init__(self, rate: float, chat_rate_per_minute: float, concurrency: int,
+                 max_attempts: int = None, retry_backoff: float = None):
+        self.global_bucket = TokenBucket(rate)
+        self.chat_rate = chat_rate_per_minute / 60
+        self.chat_buckets = {}
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts or SEND_RETRY_ATTEMPTS
+        self.retry_backoff = retry_backoff or SEND_RETRY_BACKOFF
+
+    def chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, capacity=1)
+        return bucket
+
+    async def submit(self, chat_id: int, send):
+        """Выполняет `send()` (корутинную функцию без аргументов, возвращает SEND_*) в рамках лимитов чата."""
+        bucket = self.chat_bucket(chat_id)
+        while True:
+            await bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                return await send()
+            except telegram.error.RetryAfter as e:
+                delay = retry_after_seconds(e)
+                logger.warning("RetryAfter для чата %s: пауза %.1f с, затем повтор.", chat_id, delay)
+                bucket.pause(delay)
+
+    async def run(self, chat_id: int, sends: list) -> dict:
+        """Параллельно выполняет все отправки (не более `concurrency` одновременно) и возвращает отчёт.
+
+        В отчёте, кроме итогов, — число окончательных неудач по категориям (SEND_TRANSIENT,
+        SEND_PERMANENT, SEND_CHANNEL, SEND_ERROR), число повторов и признак остановки "aborted".
+        """
+        report = {"total": len(sends), "sent": 0, "failed": 0, "retries": 0, "aborted": False,
+                  SEND_TRANSIENT: 0, SEND_PERMANENT: 0, SEND_CHANNEL: 0, SEND_ERROR: 0,
+                  "duration": 0.0, "throughput": 0.0}
+        started = time.monotonic()
+        queue = sends
+        for attempt in range(1, self.max_attempts + 1):
+            retry_queue = []
+            pending = iter(queue)
+
+            async def worker():
+                for send in pending:
+                    if report["aborted"]:
+                        return
+                    outcome = await self.submit(chat_id, send)
+                    if outcome == SEND_OK:
+                        report["sent"] += 1
+                    elif outcome == SEND_TRANSIENT and attempt < self.max_attempts:
+                        retry_queue.append(send)
+                    else:
+                        report["failed"] += 1
+                        report[outcome] += 1
+                        if outcome == SEND_CHANNEL:
+                            report["aborted"] = True
+
+            await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(queue)))))
+            if report["aborted"]:
+                logger.error("Чат %s: ошибка канала, рассылка остановлена.", chat_id)
+                break
+            if not retry_queue:
+                break
+            delay = self.retry_backoff * 2 ** (attempt - 1)
+            logger.info("Чат %s: %d отправок с временной ошибкой, повтор через %.1f с (попытка %d из %d).",
+                        chat_id, len(retry_queue), delay, attempt + 1, self.max_attempts)
+            report["retries"] += len(retry_queue)
+            await asyncio.sleep(delay)
+            queue = retry_queue
+        report["duration"] = time.monotonic() - started
+        if report["duration"] > 0:
+            report["throughput"] = report["sent"] / report["duration"]
+        return report
+
+def format_user_ids(user_ids: list, limit: int = 20) -> str:
+    shown = ", ".join(str(user_id) for user_id in user_ids[:limit])
+    return shown + (f" и ещё {len(user_ids) - limit}" if len(user_ids) > limit else "")
+
+def format_broadcast_report(report: dict) -> str:
+    return (f"Рассылка: отправлено {report['sent']} из {report['total']}, ошибок {report['failed']} "
+            f"(временных {report[SEND_TRANSIENT]}, постоянных {report[SEND_PERMANENT]}, "
+            f"ошибок канала {report[SEND_CHANNEL]}, прочих {report[SEND_ERROR]}), "
+            f"повторов {report['retries']}, "
+            f"длительность {report['duration']:.1f} с, скорость {report['throughput']:.2f} сообщ./с.")
+
+broadcast_scheduler = BroadcastScheduler(BROADCAST_RATE, CHAT_RATE_PER_MINUTE, BROADCAST_CONCURRENCY)
 
-async def send_prediction_to_user(bot: telegram.Bot, user_info: dict, prediction: dict):
+def user_label(user_info: dict) -> str:
+    """Имя пользователя для логов: username, имя или id (поля в базе могут быть NULL)."""
+    return user_info.get('username') or user_info.get('first_name') or str(user_info['id'])
+
+def format_mention(user_info: dict) -> str:
+    """Упоминание пользователя в разметке HTML: @username или ссылка tg://user?id= по имени.
+
+    Результат кэшируется в mention_cache до смены профиля (см. store_user_from_channel_message).
+    """
     user_id = user_info['id']
-    mention_name = user_info.get('username', user_info.get('first_name', str(user_id)))
+    mention = mention_cache.get(user_id)
+    if mention is None:
+        if user_info.get('username'):
+            mention = f"@{html.escape(user_info['username'])}"
+        else:
+            display_name = user_info.get('first_name') or f"User {user_id}"
+            mention = f'<a href="tg://user?id={user_id}">{html.escape(display_name)}</a>'
+        mention_cache[user_id] = mention
+    return mention
 
-    if user_info.get('username'):
-        mention = f"@{user_info['username']}"
-    else:
-        display_name = user_info.get('first_name', f"User {user_id}")
-        mention = f"[{display_name.replace('[', '').replace(']', '')}](tg://user?id={user_id})"
-    
-    message_text = f"{mention}, ваше предсказание на сегодня: {prediction['text']}"
+def render_prediction_message(user_info: dict, prediction: dict) -> str:
+    return f"{format_mention(user_info)}, ваше предсказание на сегодня: {html.escape(prediction['text'])}"
+
+def render_digest_line(user_info: dict, prediction: dict) -> str:
+    return f"{format_mention(user_info)}: {html.escape(prediction['text'])}"
+
+def telegram_length(text: str) -> int:
+    """Длина текста в единицах UTF-16 — так Telegram считает лимит в 4096 символов."""
+    return len(text.encode('utf-16-le')) // 2
+
+def pack_digest(entries: list, limit: int = TELEGRAM_MESSAGE_LIMIT, max_mentions: int = None,
+                header: str = DIGEST_HEADER) -> list:
+    """Раскладывает строки дайджеста [(user_id, text)] по как можно меньшему числу сообщений.
+
+    Упаковка best-fit decreasing: строки от длинных к коротким, каждая — в сообщение с наименьшим
+    подходящим остатком места. Сообщение — заголовок и строки через перевод строки, не длиннее
+    `limit` и не более `max_mentions` строк (в каждой одно упоминание). Длина считается по исходной
+    разметке, она не меньше длины текста после разбора. Возвращает [(user_ids, text)].
+    """
+    max_mentions = max_mentions or DIGEST_MAX_MENTIONS
+    capacity = limit - telegram_length(header)
+    sized = sorted(((telegram_length(text) + 1, user_id, text) for user_id, text in entries), reverse=True)
+    messages = []
+    # (остаток места, номер сообщения) для сообщений, куда ещё можно дописать строку; отсортирован.
+    open_messages = []
+    for size, user_id, text in sized:
+        position = bisect.bisect_left(open_messages, (size, -1))
+        if position < len(open_messages):
+            remaining, number = open_messages.pop(position)
+        else:
+            # Строка длиннее лимита тоже уходит отдельным сообщением: ошибку вернёт Telegram.
+            number, remaining = len(messages), capacity
+            messages.append(([], []))
+        user_ids, lines = messages[number]
+        user_ids.append(user_id)
+        lines.append(text)
+        remaining -= size
+        if len(lines) < max_mentions and remaining > 0:
+            bisect.insort(open_messages, (remaining, number))
+    return [(user_ids, header + "\n".join(lines)) for user_ids, lines in messages]
+
+async def send_digest_message(bot: telegram.Bot, channel: Channel, text: str, user_count: int):
+    """Отправляет одно сообщение дайджеста и возвращает исход SEND_*.
+
+    Ошибки здесь относятся к каналу, а не к пользователям, поэтому никто не удаляется из рассылки.
+    """
+    started = time.perf_counter()
+    try:
+        await bot.send_message(chat_id=channel.chat_id, text=text, parse_mode=ParseMode.HTML)
+        SEND_LATENCY.observe(time.perf_counter() - started, channel=channel.chat_id)
+        MESSAGES_SENT.inc(channel=channel.chat_id)
+        logger.debug("Дайджест для %d пользователей (%d символов) отправлен в канал %s",
+                     user_count, telegram_length(text), channel.name, extra={"sample": True})
+        return SEND_OK
+    except telegram.error.RetryAfter as e:
+        SEND_ERRORS.inc(channel=channel.chat_id, error=type(e).__name__)
+        raise
+    except telegram.error.TelegramError as e:
+        SEND_ERRORS.inc(channel=channel.chat_id, error=type(e).__name__)
+        outcome = classify_send_error(e)
+        logger.warning("Ошибка отправки дайджеста (%d пользователей) в канал %s [%s]: %s",
+                       user_count, channel.name, outcome, e,
+                       extra={"channel": channel.chat_id, "error": type(e).__name__})
+        return outcome
+    except Exception as e:
+        SEND_ERRORS.inc(channel=channel.chat_id, error=type(e).__name__)
+        logger.exception("Непредвиденная ошибка при отправке дайджеста в канал %s: %s", channel.name, e)
+        return SEND_ERROR
 
+async def send_prediction_to_user(bot: telegram.Bot, channel: Channel, user_id: int, message_text: str):
+    """Отправляет готовый текст (render_prediction_message) — в цикле рассылки только ввод-вывод.
+
+    Возвращает (исход SEND_*, описание ошибки или None). Пользователей с постоянной ошибкой
+    удаляет из рассылки вызывающий код — одной пачкой в конце рассылки.
+    """
+    started = time.perf_counter()
     try:
         await bot.send_message(
-            chat_id=TARGET_CHANNEL_ID,
+            chat_id=channel.chat_id,
             text=message_text,
-            parse_mode=ParseMode.MARKDOWN
+            parse_mode=ParseMode.HTML
         )
-        print(f"Предсказание (ID: {prediction['id']}) отправлено для {mention_name} (ID: {user_id}) в канал {TARGET_CHANNEL_ID}")
-        return True
+        SEND_LATENCY.observe(time.perf_counter() - started, channel=channel.chat_id)
+        MESSAGES_SENT.inc(channel=channel.chat_id)
+        logger.debug("Предсказание отправлено пользователю %s в канал %s",
+                     user_id, channel.name, extra={"sample": True})
+        return SEND_OK, None
+    except telegram.error.RetryAfter as e:
+        SEND_ERRORS.inc(channel=channel.chat_id, error=type(e).__name__)
+        # Паузу и повтор выполняет BroadcastScheduler.
+        raise
     except telegram.error.TelegramError as e:
-        print(f"Ошибка отправки предсказания для {mention_name} (ID: {user_id}) в канал {TARGET_CHANNEL_ID}: {e}")
-        error_text = str(e).lower()
-        if any(err_keyword in error_text for err_keyword in [
-            "user not found", "chat member not found", "bot was kicked", 
-            "user is deactivated", "chat not found", "group chat was deactivated",
-            "have no rights to send a message", "user restricted", "bot was blocked by the user"
-        ]):
-            if user_id in known_users_data:
-                print(f"Пользователь {mention_name} (ID: {user_id}) не найден/деактивирован/покинул канал/заблокировал бота или проблема с правами в канале. Удаляем из списка рассылки.")
-                del known_users_data[user_id]
-                save_known_users()
-        return False
+        SEND_ERRORS.inc(channel=channel.chat_id, error=type(e).__name__)
+        outcome = classify_send_error(e)
+        logger.warning("Ошибка отправки предсказания для %s (ID: %s) в канал %s [%s]: %s",
+                       user_label(known_users_data.get(user_id) or {'id': user_id}), user_id, channel.name, outcome, e,
+                       extra={"channel": channel.chat_id, "user_id": user_id, "error": type(e).__name__})
+        reason = str(e) if str(e).startswith(type(e).__name__) else f"{type(e).__name__}: {e}"
+        return outcome, reason
     except Exception as e:
-        print(f"Непредвиденная ошибка при отправке сообщения пользователю {user_id}: {e}")
-        return False
+        SEND_ERRORS.inc(channel=channel.chat_id, error=type(e).__name__)
+        logger.exception("Непредвиденная ошибка при отправке сообщения пользователю %s: %s", user_id, e)
+        return SEND_ERROR, f"{type(e).__name__}: {e}"
 
 async def daily_prediction_job(context: CallbackContext):
-    global predictions_sent_today_ids
-    
-    print(f"Запуск ежедневной рассылки предсказаний... Время: {datetime.datetime.now(pytz.timezone('Europe/Moscow'))}")
-    predictions_sent_today_ids.clear()
-
-    if not TARGET_CHANNEL_ID:
-        print("TARGET_CHANNEL_ID не установлен. Рассылка невозможна.")
+    channel = channels.get(context.job.data)
+    if channel is None:
+        logger.warning("Канал %s больше не настроен. Рассылка пропущена.", context.job.data)
         return
+    await run_channel_broadcast(context.bot, channel)
 
-    if not all_predictions:
-        print("Нет доступных предсказаний для отправки.")
-        if ADMIN_USER_ID:
-             try:
-                await context.bot.send_message(chat_id=ADMIN_USER_ID, text="Администратору: Список предсказаний пуст (quotes_1000.json). Не могу начать рассылку.")
-             except Exception as e: print(f"Не удалось уведомить администратора (нет предсказаний): {e}")
+async def resume_broadcasts_job(context: CallbackContext):
+    """При старте продолжает рассылки, прерванные перезапуском."""
+    store = open_user_store()
+    runs = await asyncio.get_running_loop().run_in_executor(store_executor, store.unfinished_runs)
+    resumable = [(channels[chat_id], day) for chat_id, day in runs if chat_id in channels]
+    if resumable:
+        logger.info("Найдено незавершённых рассылок: %d. Возобновляем...", len(resumable))
+    await asyncio.gather(*(run_channel_broadcast(context.bot, channel, day, resumed=True) for channel, day in resumable))
+
+async def run_channel_broadcast(bot: telegram.Bot, channel: Channel, day: int = None, resumed: bool = False):
+    """Рассылка канала за день `day` (по умолчанию — сегодня в часовом поясе канала).
+
+    План (пользователь -> предсказание) сохраняется в базе до начала отправки, а каждая
+    отправка отмечается в нём, поэтому повторный запуск за тот же день (перезапуск бота,
+    /force_send) продолжает с места остановки и не шлёт пользователю второе сообщение.
+    Отправка, прерванная между запросом к Telegram и отметкой об успехе, повторно не
+    выполняется: лучше пропустить одно сообщение, чем прислать его дважды.
+    Незавершённые рассылки прошлых дней досылает только resume_broadcasts_job (resumed=True);
+    плановая рассылка и /force_send закрывают их без отправки, чтобы никто не получил
+    вчерашнее предсказание вслед за сегодняшним.
+    """
+    async with channel.broadcast_lock:
+        if day is None:
+            await close_earlier_runs(channel)
+        await broadcast_channel_day(bot, channel, day, resumed)
+
+async def close_earlier_runs(channel: Channel):
+    store = open_user_store()
+    loop = asyncio.get_running_loop()
+    today = datetime.datetime.now(channel.timezone).date().toordinal()
+    prune_before_day = today - max(PREDICTION_USER_WINDOW_DAYS, PREDICTION_GLOBAL_WINDOW_DAYS)
+    runs = await loop.run_in_executor(store_executor, store.unfinished_runs)
+    for chat_id, day in runs:
+        if chat_id != channel.chat_id or day >= today:
+            continue
+        undelivered = await loop.run_in_executor(store_executor, store.pending_deliveries, chat_id, day)
+        logger.warning("Канал %s: рассылка за %s закрыта без досылки, не доставлено %d сообщений.",
+                       channel.name, datetime.date.fromordinal(day), len(undelivered))
+        await loop.run_in_executor(store_executor, store.finish_run, chat_id, day, prune_before_day)
+
+async def broadcast_channel_day(bot: telegram.Bot, channel: Channel, day: int = None, resumed: bool = False):
+    local_now = datetime.datetime.now(channel.timezone)
+    today = local_now.date().toordinal()
+    day = today if day is None else day
+    logger.info("Запуск ежедневной рассылки предсказаний в канал %s за %s... Время: %s",
+                channel.name, datetime.date.fromordinal(day), local_now)
+
+    store = open_user_store()
+    loop = asyncio.get_running_loop()
+    prune_before_day = day - max(PREDICTION_USER_WINDOW_DAYS, PREDICTION_GLOBAL_WINDOW_DAYS)
+    run_status, planned = await loop.run_in_executor(store_executor, store.load_run, channel.chat_id, day)
+
+    if day < today and run_status != 'running':
+        # Рассылку прошлого дня уже закрыли (плановая рассылка или /force_send) — досылать нечего.
+        logger.info("Рассылка канала %s за %s уже закрыта.", channel.name, datetime.date.fromordinal(day))
         return
-    
-    load_known_users()
 
-    if not known_users_data:
-        print("Нет известных пользователей для отправки предсказаний (никто не писал в канале, либо файл known_users.json пуст/недоступен).")
+    if day < today - 1:
+        logger.warning("Рассылка канала %s за %s устарела, закрываем без отправки.", channel.name, datetime.date.fromordinal(day))
+        await loop.run_in_executor(store_executor, store.finish_run, channel.chat_id, day, prune_before_day)
         return
 
-    users_to_message = list(known_users_data.values())
-    random.shuffle(users_to_message)
-    
-    available_predictions_for_today = [p for p in all_predictions if p['id'] not in predictions_sent_today_ids]
-    random.shuffle(available_predictions_for_today)
-    
-    if not available_predictions_for_today:
-        print("Все предсказания уже были использованы или их нет (для сегодняшней сессии).")
+    if not channel.predictions:
+        logger.error("Нет доступных предсказаний для отправки в канал %s.", channel.name)
         if ADMIN_USER_ID:
-            try:
-                await context.bot.send_message(chat_id=ADMIN_USER_ID, text="Кажется, на сегодня все предсказания уже были розданы или закончились!")
-            except Exception as e: print(f"Не удалось уведомить администратора (предсказания закончились): {e}")
+             try:
+                await bot.send_message(chat_id=ADMIN_USER_ID, text=f"Администратору: Список предсказаний пуст ({channel.predictions_file}) для канала {channel.name}. Не могу начать рассылку.")
+             except Exception as e: logger.warning("Не удалось уведомить администратора (нет предсказаний): %s", e)
+        return
+
+    planned_user_ids = {row[0] for row in planned}
+    new_user_ids = [
+        user_id for user_id in channel.members
+        if user_id not in planned_user_ids and user_id in known_users_data
+    ]
+    if not planned and not new_user_ids:
+        logger.info("Нет известных пользователей для отправки предсказаний в канал %s "
+                    "(никто не писал в канале, либо база пользователей пуста/недоступна).", channel.name)
         return
 
-    print(f"Начинаем рассылку для {len(users_to_message)} пользователей. Доступно {len(available_predictions_for_today)} предсказаний.")
+    new_rows = []
+    if new_user_ids and day == today:
+        random.shuffle(new_user_ids)
+        allocator = await load_prediction_allocator(channel, day)
+        for _, prediction_id, _, _ in planned:
+            allocator.mark_used(prediction_id)
+        for user_id in new_user_ids:
+            index = allocator.allocate(user_id)
+            if index is None:
+                break
+            new_rows.append((user_id, channel.predictions[index]['id'], index, 'pending'))
+        await loop.run_in_executor(store_executor, store.save_plan, channel.chat_id, day, allocator.state, new_rows)
 
-    for user_info in users_to_message:
-        if not available_predictions_for_today:
-            print("Уникальные предсказания на сегодня закончились, не все пользователи их получили.")
+        if len(new_rows) < len(new_user_ids):
+            logger.warning("Уникальные предсказания на сегодня для канала %s закончились, не все пользователи их получили.", channel.name)
             if ADMIN_USER_ID:
                 try:
-                    await context.bot.send_message(chat_id=ADMIN_USER_ID, text="Уникальные предсказания на сегодня закончились!")
-                except Exception as e: print(f"Не удалось уведомить администратора (уникальные предсказания закончились): {e}")
-            break
-
-        current_prediction = available_predictions_for_today.pop(0)
-        success = await send_prediction_to_user(context.bot, user_info, current_prediction)
-        
-        if success:
-            predictions_sent_today_ids.add(current_prediction['id'])
-            print(f"Осталось {len(available_predictions_for_today)} уникальных предсказаний на сегодня.")
-            await asyncio.sleep(30)
+                    await bot.send_message(chat_id=ADMIN_USER_ID, text=f"Уникальные предсказания на сегодня для канала {channel.name} закончились!")
+                except Exception as e: logger.warning("Не удалось уведомить администратора (уникальные предсказания закончились): %s", e)
+
+    pending = [row for row in planned if row[3] == 'pending'] + new_rows
+    if not pending:
+        logger.info("Рассылка в канал %s за %s уже выполнена, отправлять некому.", channel.name, datetime.date.fromordinal(day))
+        if run_status == 'running':
+            await loop.run_in_executor(store_executor, store.finish_run, channel.chat_id, day, prune_before_day)
+        return
+
+    continued = run_status == 'running' and len(pending) > len(new_rows)
+    resumed = resumed and continued
+    logger.info("%s рассылку в канал %s: %d пользователей в очереди, уже обработано %d.",
+                'Продолжаем' if continued else 'Начинаем', channel.name, len(pending),
+                len(planned) - (len(pending) - len(new_rows)))
+
+    async def set_status(user_ids, status):
+        await loop.run_in_executor(store_executor, store.set_delivery_status, channel.chat_id, day, user_ids, status)
+
+    # После временной ошибки или ошибки канала доставка снова ждёт отправки: её повторит очередь повтора,
+    # а если попытки кончились или рассылка остановлена — /force_send в тот же день или перезапуск бота.
+    delivery_status = {SEND_OK: 'sent', SEND_TRANSIENT: 'pending', SEND_CHANNEL: 'pending'}
+    # Надгробия: user_id -> причина. Применяются одной пачкой после рассылки.
+    tombstones = {}
+    channel_errors = []
+
+    def make_send(user_id, message_text):
+        async def send():
+            # Пользователь мог быть удалён из канала уже во время рассылки.
+            if user_id not in channel.members:
+                await set_status([user_id], 'failed')
+                return SEND_ERROR
+            await set_status([user_id], 'sending')
+            outcome, reason = await send_prediction_to_user(bot, channel, user_id, message_text)
+            if outcome == SEND_PERMANENT:
+                tombstones[user_id] = reason
+            elif outcome == SEND_CHANNEL:
+                channel_errors.append(reason)
+            await set_status([user_id], delivery_status.get(outcome, 'failed'))
+            return outcome
+        return send
+
+    def make_digest_send(user_ids, text):
+        # Все пользователи сообщения отмечаются вместе: при сбое посреди отправки дайджест не повторяется.
+        async def send():
+            await set_status(user_ids, 'sending')
+            outcome = await send_digest_message(bot, channel, text, len(user_ids))
+            await set_status(user_ids, delivery_status.get(outcome, 'failed'))
+            return outcome
+        return send
+
+    # Все тексты готовятся до начала отправки, чтобы в полосах с ограничением скорости был только ввод-вывод.
+    render = render_digest_line if channel.digest else render_prediction_message
+    payloads, skipped = [], []
+    for position, (user_id, prediction_id, index, _) in enumerate(pending, 1):
+        user_info = known_users_data.get(user_id)
+        prediction = find_prediction(channel, prediction_id, index)
+        if user_info is None or user_id not in channel.members or prediction is None:
+            skipped.append(user_id)
         else:
-            print(f"Пропуск задержки для пользователя из-за ошибки отправки.")
-    
-    print("Ежедневная рассылка завершена.")
+            payloads.append((user_id, render(user_info, prediction)))
+        if position % 1000 == 0:
+            # Не задерживаем обработку апдейтов на больших каналах.
+            await asyncio.sleep(0)
+    if skipped:
+        await set_status(skipped, 'failed')
+
+    notes = ""
+    if skipped:
+        notes += f" Пропущено (нет пользователя или предсказания): {len(skipped)}."
+    if channel.digest:
+        digests = pack_digest(payloads)
+        sends = [make_digest_send(user_ids, text) for user_ids, text in digests]
+        notes += f" Режим дайджеста: {len(payloads)} пользователей в {len(digests)} сообщениях."
+    else:
+        sends = [make_send(user_id, message_text) for user_id, message_text in payloads]
 
+    report = await broadcast_scheduler.run(channel.chat_id, sends)
+    if tombstones:
+        for user_id in tombstones:
+            channel.members.discard(user_id)
+        await loop.run_in_executor(store_executor, store.apply_tombstones, channel.chat_id, list(tombstones.items()))
+        logger.info("Канал %s: удалено из рассылки пользователей с постоянными ошибками отправки: %d.",
+                    channel.name, len(tombstones))
+        notes += f" Удалено из рассылки: {len(tombstones)}."
+    if report["aborted"]:
+        reason = f" ({channel_errors[0]})" if channel_errors else ""
+        notes += (f" Рассылка остановлена из-за ошибки канала{reason}: проверьте, что бот остаётся "
+                  f"администратором канала с правом отправки сообщений.")
+    # Пока есть неотправленные доставки, рассылка остаётся незавершённой: её продолжит /force_send
+    # в тот же день или перезапуск бота; следующая плановая рассылка закроет её без досылки.
+    undelivered = await loop.run_in_executor(store_executor, store.pending_deliveries, channel.chat_id, day)
+    if undelivered:
+        logger.warning("Канал %s: не доставлено %d сообщений, рассылка за %s остаётся незавершённой.",
+                       channel.name, len(undelivered), datetime.date.fromordinal(day))
+        notes += (f" Не доставлено: {len(undelivered)} (ID: {format_user_ids(undelivered)}); "
+                  f"дослать можно командой /force_send сегодня.")
+    else:
+        await loop.run_in_executor(store_executor, store.finish_run, channel.chat_id, day, prune_before_day)
+    BROADCAST_DURATION.observe(report["duration"], channel=channel.chat_id)
+
+    report_text = f"Канал {channel.name}{' (рассылка возобновлена после перезапуска)' if resumed else ''}. {format_broadcast_report(report)}{notes}"
+    logger.info("%s", report_text, extra={"channel": channel.chat_id, "report": report})
+    if ADMIN_USER_ID:
+        try:
+            await bot.send_message(chat_id=ADMIN_USER_ID, text=report_text)
+        except Exception as e: logger.warning("Не удалось отправить администратору отчёт о рассылке: %s", e)
+
+@timed_handler
 async def store_user_from_channel_message(update: Update, context: CallbackContext):
-    print(f"--- store_user_from_channel_message ВЫЗВАНА для чата {update.message.chat_id if update.message else 'нет сообщения'} ---")
-
-    if not update.message or not update.message.from_user or not TARGET_CHANNEL_ID:
-        print(f"--- store_user_from_channel_message: Прерывание (нет сообщения, пользователя или TARGET_CHANNEL_ID). "
-              f"update.message: {'Есть' if update.message else 'Нет'}, "
-              f"update.message.from_user: {'Есть' if update.message and update.message.from_user else 'Нет'}, "
-              f"TARGET_CHANNEL_ID: {TARGET_CHANNEL_ID}")
-        return 
-
-    user = update.message.from_user
-    if user.is_bot:
-        print(f"--- store_user_from_channel_message: Прерывание (сообщение от бота {user.id}) ---")
+    # Горячий путь: вызывается на каждое сообщение в канале. Только работа со словарём в памяти,
+    # запись на диск — в flush_known_users() вне цикла событий.
+    message = update.message
+    if not message or not message.from_user:
         return
-
-    if update.message.chat_id != TARGET_CHANNEL_ID:
-        print(f"--- store_user_from_channel_message: Прерывание (сообщение из другого чата: {update.message.chat_id}, ожидался {TARGET_CHANNEL_ID}) ---")
+    user = message.from_user
+    channel = channels.get(message.chat_id)
+    if user.is_bot or channel is None:
         return
-    
-    print(f"--- store_user_from_channel_message: Сообщение из целевого чата {TARGET_CHANNEL_ID} от пользователя {user.id} ({user.first_name} @{user.username}) ---")
 
     user_id_int = user.id
-    if user_id_int not in known_users_data or \
-       known_users_data[user_id_int].get('username') != user.username or \
-       known_users_data[user_id_int].get('first_name') != user.first_name or \
-       known_users_data[user_id_int].get('last_name') != user.last_name:
-        
-        known_users_data[user_id_int] = {
-            "id": user_id_int,
-            "first_name": user.first_name,
-            "last_name": user.last_name,
-            "username": user.username
-        }
-        save_known_users()
-        print(f"Пользователь {user.first_name} (ID: {user_id_int}, Username: @{user.username}) "
-              f"обнаружен/обновлен в канале {TARGET_CHANNEL_ID}. "
-              f"Всего пользователей в памяти: {len(known_users_data)}")
-    else:
-        print(f"--- store_user_from_channel_message: Данные пользователя {user_id_int} уже актуальны, не сохраняем. ---")
+    if user_id_int not in channel.members:
+        channel.members.add(user_id_int)
+        mark_member_dirty(channel.chat_id, user_id_int)
+    now = time.time()
+    known = known_users_data.get(user_id_int)
+    if known is not None and known.get('username') == user.username and \
+       known.get('first_name') == user.first_name and known.get('last_name') == user.last_name:
+        if now - (known.get('last_seen') or 0) >= LAST_SEEN_RESOLUTION:
+            known['last_seen'] = now
+            mark_user_dirty(user_id_int)
+        return
+
+    mention_cache.pop(user_id_int, None)
+    known_users_data[user_id_int] = {
+        "id": user_id_int,
+        "first_name": user.first_name,
+        "last_name": user.last_name,
+        "username": user.username,
+        "last_seen": now
+    }
+    mark_user_dirty(user_id_int)
+    logger.debug("Пользователь %s (ID: %s, Username: @%s) %s в канале %s. Всего пользователей в памяти: %d",
+                 user.first_name, user_id_int, user.username, 'обновлен' if known else 'обнаружен',
+                 channel.name, len(known_users_data), extra={"sample": True})
 
+@timed_handler
 async def start_command(update: Update, context: CallbackContext):
     user = update.effective_user
-    print(f"!!! ПОЛУЧЕНА КОМАНДА /start от пользователя {user.id} ({user.first_name}) в ЛС !!!")
+    logger.info("Команда /start от пользователя %s (%s)", user.id, user.first_name)
+    schedule_lines = "\n".join(
+        f"- {channel.name} (ID: {channel.chat_id}): ежедневно в {channel.schedule_text()}"
+        for channel in channels.values()
+    )
     await update.message.reply_text(
-        f"Привет, {user.first_name}! Я бот предсказаний для канала (ID: {TARGET_CHANNEL_ID}).\n"
-        f"Предсказания отправляются активным участникам этого канала ежедневно в {SCHEDULE_HOUR:02d}:{SCHEDULE_MINUTE:02d} МСК.\n"
-        "Чтобы получать предсказания, просто будьте участником указанного канала и проявляйте там активность (пишите сообщения). "
+        f"Привет, {user.first_name}! Я бот предсказаний для каналов:\n{schedule_lines}\n"
+        "Предсказания отправляются активным участникам каждого канала по его расписанию.\n"
+        "Чтобы получать предсказания, просто будьте участником канала и проявляйте там активность (пишите сообщения). "
         "Ваши данные (ID, имя, юзернейм) будут сохранены для этой цели."
     )
-    print(f"!!! Ответ на /start отправлен пользователю {user.id} !!!")
 
 
+@timed_handler
 async def help_command(update: Update, context: CallbackContext):
     user = update.effective_user
-    print(f"!!! ПОЛУЧЕНА КОМАНДА /help от пользователя {user.id} ({user.first_name}) в ЛС !!!")
+    logger.info("Команда /help от пользователя %s (%s)", user.id, user.first_name)
     help_text = (
         "Я бот для отправки ежедневных предсказаний в канал.\n"
         "Предсказания получают пользователи, которые пишут сообщения в целевом канале.\n\n"
@@ -254,55 +1380,219 @@ async def help_command(update: Update, context: CallbackContext):
     if ADMIN_USER_ID and update.effective_user and update.effective_user.id == ADMIN_USER_ID:
         help_text += (
             "\nКоманды администратора:\n"
-            "/list_users - Показать список пользователей, для которых будут отправляться предсказания.\n"
-            "/force_send - Принудительно запустить рассылку (для теста).\n"
+            "/list_users [chat_id] [поиск] - Список пользователей, которым отправляются предсказания, "
+            "по страницам; поиск по началу username или по ID.\n"
+            "/stats - Активность участников каналов и удаления из рассылки.\n"
+            "/force_send [chat_id] - Принудительно запустить рассылку во все каналы или в один: "
+            "получат только те, кому сегодня ещё не отправлено.\n"
+            "/storage_stats - Состояние отложенной записи пользователей в базу.\n"
         )
     await update.message.reply_text(help_text)
-    print(f"!!! Ответ на /help отправлен пользователю {user.id} !!!")
 
 
+def list_users_callback_data(chat_id: int, cursor: int, backward: bool, start: int, total: int, query: str) -> str:
+    """Кнопка /list_users: канал, курсор keyset-пагинации, позиция страницы и (при поиске) число найденных.
+
+    Позиция и число найденных передаются дальше, чтобы не пересчитывать их на каждой странице.
+    """
+    data = f"lu:{chat_id}:{'<' if backward else '>'}{cursor}:{start}:{total if query else ''}:"
+    # callback_data ограничен 64 байтами, поэтому строка поиска в нём обрезается.
+    return data + query.encode('utf-8')[:64 - len(data)].decode('utf-8', errors='ignore')
+
+async def render_members_page(channel: Channel, cursor: int = 0, backward: bool = False, query: str = "",
+                              start: int = 0, total: int = None):
+    """Текст и клавиатура одной страницы /list_users; выборка идёт из базы по индексам в store_executor.
+
+    start — позиция первой строки страницы, total — число найденных по `query` (None — посчитать).
+    """
+    # Сначала догоняем базу до состояния в памяти, иначе недавние участники не попадут в выборку.
+    await flush_known_users()
+    search_id = int(query) if query.isdigit() else None
+    prefix = query.lstrip('@') if query and search_id is None else None
+    count = bool(query) and total is None
+    store = open_user_store()
+    rows, counted = await asyncio.get_running_loop().run_in_executor(
+        store_executor, store.members_page, channel.chat_id, cursor, backward, prefix, search_id,
+        LIST_USERS_PAGE_SIZE, count
+    )
+    if not query:
+        total = len(channel.members)
+    elif count:
+        total = counted
+    text = f"Канал {channel.name} (ID: {channel.chat_id}), участников: {len(channel.members)}"
+    if query:
+        text += f"\nПоиск «{query}»: найдено {total}"
+    if not rows:
+        return text + "\nНикого не найдено.", None
+
+    lines = []
+    for user_id, first_name, last_name, username in rows:
+        name = f"@{username}" if username else first_name or f"User {user_id}"
+        lines.append(f"- {name} (ID: {user_id})")
+    text += f"\nПоказаны {start + 1}–{start + len(rows)} из {total}:\n" + "\n".join(lines)
+    buttons = []
+    if start > 0:
+        buttons.append(InlineKeyboardButton("« Назад", callback_data=list_users_callback_data(
+            channel.chat_id, rows[0][0], True, max(0, start - LIST_USERS_PAGE_SIZE), total, query
+        )))
+    if start + len(rows) < total:
+        buttons.append(InlineKeyboardButton("Вперёд »", callback_data=list_users_callback_data(
+            channel.chat_id, rows[-1][0], False, start + len(rows), total, query
+        )))
+    return text, InlineKeyboardMarkup([buttons]) if buttons else None
+
+@timed_handler
 async def list_users_command(update: Update, context: CallbackContext):
     user = update.effective_user
-    print(f"!!! ПОЛУЧЕНА КОМАНДА /list_users от пользователя {user.id} ({user.first_name}) в ЛС !!!")
+    logger.info("Команда /list_users от пользователя %s (%s)", user.id, user.first_name)
     if not (ADMIN_USER_ID and user and user.id == ADMIN_USER_ID):
         await update.message.reply_text("Эта команда доступна только администратору бота.")
-        print(f"!!! Пользователю {user.id} отказано в доступе к /list_users !!!")
+        logger.warning("Пользователю %s отказано в доступе к /list_users", user.id)
         return
 
-    load_known_users()
-    if not known_users_data:
-        await update.message.reply_text("Список отслеживаемых пользователей пуст (никто еще не писал в целевом канале, либо файл не загружен).")
+    if not channels:
+        await update.message.reply_text("Не настроено ни одного канала.")
         return
 
-    message = "Пользователи, для которых будут отправляться предсказания (из known_users.json):\n"
-    for user_id_key, info in known_users_data.items(): 
-        name = f"@{info['username']}" if info.get('username') else info.get('first_name', f'User {info["id"]}')
-        message += f"- {name} (ID: {info['id']})\n" 
-    
-    max_len = 4096
-    for i in range(0, len(message), max_len):
-        await update.message.reply_text(message[i:i+max_len])
-    print(f"!!! Список пользователей отправлен администратору {user.id} !!!")
+    # /list_users [chat_id] [поиск по username или id]
+    args = list(context.args or [])
+    channel = None
+    if args:
+        try:
+            channel = channels.get(int(args[0]))
+        except ValueError:
+            pass
+        if channel is not None:
+            args.pop(0)
+    query = " ".join(args)
+    if channel is None and len(channels) == 1:
+        channel = next(iter(channels.values()))
+
+    if channel is None:
+        lines = [f"- {channel.name} (ID: {channel.chat_id}): {len(channel.members)} польз." for channel in channels.values()]
+        keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton(channel.name, callback_data=list_users_callback_data(channel.chat_id, 0, False, 0, None, query))]
+            for channel in channels.values()
+        ])
+        await update.message.reply_text(
+            f"Всего участников во всех каналах: {sum(len(channel.members) for channel in channels.values())}\n"
+            + "\n".join(lines) + "\n\nВыберите канал:",
+            reply_markup=keyboard
+        )
+        return
+
+    text, keyboard = await render_members_page(channel, query=query)
+    await update.message.reply_text(text, reply_markup=keyboard)
+
+@timed_handler
+async def list_users_callback(update: Update, context: CallbackContext):
+    """Листание страниц /list_users по кнопкам."""
+    callback_query = update.callback_query
+    user = callback_query.from_user
+    if not (ADMIN_USER_ID and user and user.id == ADMIN_USER_ID):
+        await callback_query.answer("Эта команда доступна только администратору бота.", show_alert=True)
+        return
+    try:
+        _, chat_id, cursor, start, total, query = callback_query.data.split(":", 5)
+        channel = channels[int(chat_id)]
+        backward, cursor, start = cursor[0] == "<", int(cursor[1:]), int(start)
+        total = int(total) if total else None
+    except (ValueError, KeyError, IndexError):
+        await callback_query.answer("Список устарел, выполните /list_users ещё раз.")
+        return
+    await callback_query.answer()
+    text, keyboard = await render_members_page(channel, cursor, backward, query, start, total)
+    try:
+        await callback_query.edit_message_text(text, reply_markup=keyboard)
+    except telegram.error.BadRequest as e:
+        # "Message is not modified" при повторном нажатии на ту же кнопку.
+        logger.debug("Страница /list_users не обновлена: %s", e)
+
+@timed_handler
+async def stats_command(update: Update, context: CallbackContext):
+    user = update.effective_user
+    logger.info("Команда /stats от пользователя %s (%s)", user.id, user.first_name)
+    if not (ADMIN_USER_ID and user and user.id == ADMIN_USER_ID):
+        await update.message.reply_text("Эта команда доступна только администратору бота.")
+        logger.warning("Пользователю %s отказано в доступе к /stats", user.id)
+        return
+
+    await flush_known_users()
+    store = open_user_store()
+    loop = asyncio.get_running_loop()
+    now = time.time()
+    sections = [f"Пользователей в базе: {len(known_users_data)}"]
+    for channel in channels.values():
+        stats = await loop.run_in_executor(store_executor, store.channel_stats, channel.chat_id, now)
+        last_seen = stats["last_seen"]
+        total_removed, removed_day, removed_week = stats["removals"]
+        section = (
+            f"Канал {channel.name} (ID: {channel.chat_id}): участников {len(channel.members)}, "
+            f"активных за 7 дней {last_seen.get('day', 0) + last_seen.get('week', 0)}\n"
+            f"Последнее сообщение: за сутки {last_seen.get('day', 0)}, за 2–7 дней {last_seen.get('week', 0)}, "
+            f"за 8–30 дней {last_seen.get('month', 0)}, раньше {last_seen.get('older', 0)}, "
+            f"нет данных {last_seen.get('unknown', 0)}\n"
+            f"Удалено из рассылки: за сутки {removed_day}, за 7 дней {removed_week}, всего {total_removed}"
+        )
+        if stats["reasons"]:
+            section += "\nЧастые причины за 30 дней: " + "; ".join(
+                f"{reason} — {count}" for reason, count in stats["reasons"]
+            )
+        sections.append(section)
+    await update.message.reply_text("\n\n".join(sections))
+
+
+@timed_handler
+async def storage_stats_command(update: Update, context: CallbackContext):
+    user = update.effective_user
+    logger.info("Команда /storage_stats от пользователя %s (%s)", user.id, user.first_name)
+    if not (ADMIN_USER_ID and user and user.id == ADMIN_USER_ID):
+        await update.message.reply_text("Эта команда доступна только администратору бота.")
+        logger.warning("Пользователю %s отказано в доступе к /storage_stats", user.id)
+        return
+
+    await update.message.reply_text(
+        f"Пользователей в памяти: {len(known_users_data)}\n"
+        f"Ожидают записи в базу: {len(dirty_user_ids)} профилей, {len(dirty_members)} изменений участия в каналах\n"
+        f"Интервал сброса: {USERS_FLUSH_INTERVAL:g} с\n"
+        f"Последний сброс: {user_flush_stats['last_batch']} записей за {user_flush_stats['last_latency'] * 1000:.1f} мс\n"
+        f"Всего сбросов: {user_flush_stats['flushes']}, записей: {user_flush_stats['records']}"
+    )
 
 
+@timed_handler
 async def force_send_command(update: Update, context: CallbackContext):
     user = update.effective_user
-    print(f"!!! ПОЛУЧЕНА КОМАНДА /force_send от пользователя {user.id} ({user.first_name}) в ЛС !!!")
+    logger.info("Команда /force_send от пользователя %s (%s)", user.id, user.first_name)
     if not (ADMIN_USER_ID and user and user.id == ADMIN_USER_ID):
         await update.message.reply_text("Эта команда доступна только администратору бота.")
-        print(f"!!! Пользователю {user.id} отказано в доступе к /force_send !!!")
+        logger.warning("Пользователю %s отказано в доступе к /force_send", user.id)
         return
     
-    if not TARGET_CHANNEL_ID:
-        await update.message.reply_text("TARGET_CHANNEL_ID не установлен. Не могу запустить рассылку.")
+    if not channels:
+        await update.message.reply_text("Не настроено ни одного канала. Не могу запустить рассылку.")
         return
 
-    await update.message.reply_text("Принудительный запуск рассылки предсказаний...")
-    print(f"!!! Администратор {user.id} запустил /force_send !!!")
-    await daily_prediction_job(context)
+    targets = list(channels.values())
+    if context.args:
+        try:
+            targets = [channels[int(context.args[0])]]
+        except (ValueError, KeyError):
+            await update.message.reply_text(f"Канал {context.args[0]} не настроен. Доступные: {', '.join(str(chat_id) for chat_id in channels)}")
+            return
+
+    busy = [channel for channel in targets if channel.broadcast_lock.locked()]
+    if busy:
+        await update.message.reply_text(
+            f"Рассылка уже идёт в каналах: {', '.join(channel.name for channel in busy)}. "
+            "Повторный запуск дождётся её окончания и отправит только тем, кто ещё не получил предсказание."
+        )
+    await update.message.reply_text(f"Принудительный запуск рассылки предсказаний ({len(targets)} канал(ов))...")
+    logger.info("Администратор %s запустил /force_send", user.id)
+    await asyncio.gather(*(run_channel_broadcast(context.bot, channel) for channel in targets))
 
 async def error_handler(update: object, context: CallbackContext) -> None:
-    print(f"Исключение при обработке обновления: {context.error}")
+    logger.error("Исключение при обработке обновления: %s", context.error, exc_info=context.error)
     if ADMIN_USER_ID:
         try:
             error_message = f"Произошла ошибка в боте:\n"
@@ -316,77 +1606,136 @@ async def error_handler(update: object, context: CallbackContext) -> None:
 
             await context.bot.send_message(chat_id=ADMIN_USER_ID, text=error_message)
         except Exception as e:
-            print(f"Не удалось отправить сообщение об ошибке администратору (обработка ошибки): {e}")
+            logger.warning("Не удалось отправить сообщение об ошибке администратору (обработка ошибки): %s", e)
 
+@timed_handler
 async def ping_command(update: Update, context: CallbackContext):
     user = update.effective_user
-    print(f"!!! ПОЛУЧЕНА КОМАНДА /ping от пользователя {user.id} ({user.first_name}) в ЛС !!!")
+    logger.info("Команда /ping от пользователя %s (%s)", user.id, user.first_name)
     await update.message.reply_text(f"Pong! Привет, {user.first_name}! Я жив.")
-    print(f"!!! Ответ на /ping отправлен пользователю {user.id} !!!")
+
+def allowed_update_types(application: Application) -> list:
+    """Типы апдейтов, которые разбирают зарегистрированные обработчики, — остальные Telegram не присылает.
+
+    Команды и сообщения обрабатываются только как новые сообщения (не правки и не посты каналов).
+    """
+    update_types = set()
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if isinstance(handler, (CommandHandler, MessageHandler)):
+                update_types.add(Update.MESSAGE)
+            elif isinstance(handler, CallbackQueryHandler):
+                update_types.add(Update.CALLBACK_QUERY)
+            else:
+                # Незнакомый обработчик — не рискуем потерять его апдейты.
+                return list(Update.ALL_TYPES)
+    return sorted(update_types)
 
 def main():
-    print("Запуск main функции...")
-    if not TELEGRAM_BOT_TOKEN or not TARGET_CHANNEL_ID_STR:
-        print("КРИТИЧЕСКАЯ ОШИБКА: Отсутствуют TELEGRAM_BOT_TOKEN или TARGET_CHANNEL_ID_STR. Бот не может быть запущен.")
+    if not TELEGRAM_BOT_TOKEN:
+        logger.critical("Отсутствует TELEGRAM_BOT_TOKEN. Бот не может быть запущен.")
+        return
+    if WEBHOOK_URL and not WEBHOOK_SECRET_TOKEN:
+        logger.critical("Для режима вебхука нужен WEBHOOK_SECRET_TOKEN. Бот не может быть запущен.")
         return
 
-    print("Загрузка данных...")
-    load_predictions_from_file()
+    load_channels()
+    if not channels:
+        logger.critical("Не настроено ни одного канала (TARGET_CHANNEL_ID или CHANNELS_FILE). Бот не может быть запущен.")
+        return
     load_known_users()
 
-    print("Создание экземпляра Application...")
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    metrics_server = None
+
+    async def on_startup(application: Application):
+        nonlocal metrics_server
+        if METRICS_PORT:
+            metrics_server = await start_metrics_server(METRICS_LISTEN, METRICS_PORT)
+            logger.info("Метрики доступны на http://%s:%d/metrics", METRICS_LISTEN, METRICS_PORT)
+
+    async def on_shutdown(application: Application):
+        logger.info("Остановка бота: сохраняем несохранённые данные пользователей...")
+        await flush_known_users()
+        store_executor.shutdown(wait=True)
+        if metrics_server is not None:
+            metrics_server.close()
+
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(UPDATE_CONCURRENCY)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if TELEGRAM_API_BASE_URL:
+        builder = builder.base_url(TELEGRAM_API_BASE_URL)
+    application = builder.build()
 
     application.add_handler(CommandHandler("ping", ping_command)) 
-    print("Добавлен обработчик /ping для личных сообщений.")
 
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("list_users", list_users_command))
+    application.add_handler(CallbackQueryHandler(list_users_callback, pattern=r"^lu:"))
+    application.add_handler(CommandHandler("stats", stats_command))
     application.add_handler(CommandHandler("force_send", force_send_command))
-    print("Добавлены обработчики /start, /help, /list_users, /force_send.")
+    application.add_handler(CommandHandler("storage_stats", storage_stats_command))
 
 
-    if TARGET_CHANNEL_ID:
-        application.add_handler(MessageHandler(
-            filters.Chat(chat_id=TARGET_CHANNEL_ID) & filters.TEXT & (~filters.COMMAND) & (~filters.UpdateType.EDITED_MESSAGE),
-            store_user_from_channel_message
-        ))
-        print(f"Настроен обработчик store_user_from_channel_message для чата ID: {TARGET_CHANNEL_ID}")
+    channel_filter = filters.Chat(chat_id=list(channels))
+    application.add_handler(MessageHandler(
+        channel_filter & filters.TEXT & (~filters.COMMAND) & (~filters.UpdateType.EDITED_MESSAGE),
+        store_user_from_channel_message
+    ))
+    logger.info("Настроен обработчик store_user_from_channel_message для чатов: %s", ", ".join(str(chat_id) for chat_id in channels))
+
+    @timed_handler
+    async def test_channel_command(update: Update, context: CallbackContext):
+        user_obj = update.message.from_user
+        user_id_str = str(user_obj.id) if user_obj else "Неизвестно"
+        logger.info("Команда /testchannel в чате %s от пользователя %s", update.message.chat_id, user_id_str)
+        try:
+            reply_text = f"Тестовая команда из чата {update.message.chat_id} получена!"
+            if user_obj:
+                reply_text += f" ID пользователя: {user_obj.id}"
+            await update.message.reply_text(reply_text)
+        except Exception as e:
+            logger.warning("Ошибка при ответе на /testchannel в чате %s: %s", update.message.chat_id, e)
+
+    application.add_handler(CommandHandler("testchannel", test_channel_command, filters=channel_filter))
 
-        async def test_channel_command(update: Update, context: CallbackContext):
-            user_obj = update.message.from_user
-            user_id_str = str(user_obj.id) if user_obj else "Неизвестно"
-            print(f"!!! ПОЛУЧЕНA КОМАНДА /testchannel В ЧАТЕ {update.message.chat_id} ОТ ПОЛЬЗОВАТЕЛЯ {user_id_str} !!!")
-            try:
-                reply_text = f"Тестовая команда из чата {update.message.chat_id} получена!"
-                if user_obj:
-                    reply_text += f" ID пользователя: {user_obj.id}"
-                await update.message.reply_text(reply_text)
-                print(f"!!! Ответ на /testchannel отправлен в чат {update.message.chat_id} !!!")
-            except Exception as e:
-                print(f"!!! Ошибка при ответе на /testchannel в чате {update.message.chat_id}: {e} !!!")
-        
-        application.add_handler(CommandHandler("testchannel", test_channel_command, filters=filters.Chat(chat_id=TARGET_CHANNEL_ID)))
-        print(f"Добавлен тестовый обработчик /testchannel для чата с ID: {TARGET_CHANNEL_ID}")
-    else:
-        print("Обработчики для TARGET_CHANNEL_ID не настроены, так как TARGET_CHANNEL_ID не задан или невалиден.")
-    
     application.add_error_handler(error_handler)
 
     job_queue = application.job_queue
-    moscow_tz = pytz.timezone('Europe/Moscow')
-    target_time_dt = datetime.time(hour=SCHEDULE_HOUR, minute=SCHEDULE_MINUTE, tzinfo=moscow_tz)
-    
-    job_queue.run_daily(daily_prediction_job, time=target_time_dt, name="daily_predictions_job")
-    
-    print(f"Бот настроен. Ежедневная рассылка в {SCHEDULE_HOUR:02d}:{SCHEDULE_MINUTE:02d} по московскому времени.")
-    print(f"Текущее время по МСК: {datetime.datetime.now(moscow_tz).strftime('%H:%M:%S %Z')}")
-    if ADMIN_USER_ID:
-        print(f"ID администратора: {ADMIN_USER_ID}")
+    for channel in channels.values():
+        target_time_dt = datetime.time(hour=channel.schedule_hour, minute=channel.schedule_minute, tzinfo=channel.timezone)
+        job_queue.run_daily(
+            daily_prediction_job, time=target_time_dt,
+            name=f"daily_predictions_job:{channel.chat_id}", data=channel.chat_id
+        )
+        logger.info("Канал %s: ежедневная рассылка в %s, текущее время там: %s",
+                    channel.name, channel.schedule_text(), datetime.datetime.now(channel.timezone).strftime('%H:%M:%S %Z'))
+    job_queue.run_repeating(flush_users_job, interval=USERS_FLUSH_INTERVAL, name="flush_users_job")
+    job_queue.run_once(resume_broadcasts_job, when=1, name="resume_broadcasts_job")
 
-    print("Запуск бота (polling)...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    logger.info("Бот настроен. Каналов: %d. ID администратора: %s", len(channels), ADMIN_USER_ID)
+
+    allowed_updates = allowed_update_types(application)
+    logger.info("Получаемые типы апдейтов: %s", ", ".join(allowed_updates))
+    if WEBHOOK_URL:
+        logger.info("Запуск бота (webhook) на %s:%d/%s...", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH)
+        # Апдейты без верного заголовка X-Telegram-Bot-Api-Secret-Token сервер отклоняет с кодом 403.
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            allowed_updates=allowed_updates
+        )
+    else:
+        logger.info("Запуск бота (polling)...")
+        application.run_polling(allowed_updates=allowed_updates)
 
 if __name__ == '__main__':
     main()
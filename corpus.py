@@ -0,0 +1,111 @@
+"""Компактный формат корпуса предсказаний с индексом смещений, читаемый через mmap.
+
+Структура файла (все числа little-endian):
+    заголовок   4s magic b"PRDC", uint32 версия, uint64 количество записей N
+    ids         N x int64  — id предсказаний по возрастанию
+    offsets     (N + 1) x uint64 — смещения текстов относительно начала секции текстов
+    texts       тексты в UTF-8 подряд
+
+Доступ по индексу — O(1), по id — O(1) для плотной нумерации (как в quotes_1000.json),
+иначе двоичный поиск. В память подгружаются только страницы с нужными текстами.
+
+Конвертация из JSON-массива:
+    python corpus.py quotes_1000.json quotes_1000.bin
+"""
+import bisect
+import json
+import mmap
+import struct
+import sys
+
+MAGIC = b"PRDC"
+VERSION = 1
+HEADER = struct.Struct("<4sIQ")
+
+
+class MappedCorpus:
+    """Корпус предсказаний из файла формата PRDC; ведёт себя как список словарей {'id', 'text'}."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path}: неизвестный формат корпуса ({magic!r}, версия {version})")
+        view = memoryview(self._mmap)
+        ids_start = HEADER.size
+        offsets_start = ids_start + 8 * count
+        self._texts_start = offsets_start + 8 * (count + 1)
+        self._ids = view[ids_start:offsets_start].cast('q')
+        self._offsets = view[offsets_start:self._texts_start].cast('Q')
+        self._count = count
+        self._dense = count > 0 and self._ids[-1] - self._ids[0] == count - 1
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index: int) -> dict:
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        start = self._texts_start + self._offsets[index]
+        end = self._texts_start + self._offsets[index + 1]
+        return {"id": self._ids[index], "text": self._mmap[start:end].decode('utf-8')}
+
+    def index_of(self, prediction_id: int):
+        """Индекс предсказания с данным id или None."""
+        if not self._count:
+            return None
+        if self._dense:
+            index = prediction_id - self._ids[0]
+            return index if 0 <= index < self._count else None
+        index = bisect.bisect_left(self._ids, prediction_id)
+        return index if index < self._count and self._ids[index] == prediction_id else None
+
+    def get_by_id(self, prediction_id: int):
+        index = self.index_of(prediction_id)
+        return None if index is None else self[index]
+
+    def close(self):
+        self._ids.release()
+        self._offsets.release()
+        self._mmap.close()
+
+
+def write_corpus(predictions, path: str) -> int:
+    """Записывает предсказания (итерируемое словарей {'id', 'text'}) в формате PRDC."""
+    records = sorted((int(p['id']), p['text'].encode('utf-8')) for p in predictions)
+    ids = [prediction_id for prediction_id, _ in records]
+    if len(set(ids)) != len(ids):
+        raise ValueError("В корпусе есть повторяющиеся id предсказаний")
+    offsets = [0]
+    for _, text in records:
+        offsets.append(offsets[-1] + len(text))
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(records)))
+        f.write(struct.pack(f"<{len(ids)}q", *ids))
+        f.write(struct.pack(f"<{len(offsets)}Q", *offsets))
+        for _, text in records:
+            f.write(text)
+    return len(records)
+
+
+def convert_json(json_path: str, corpus_path: str) -> int:
+    with open(json_path, 'r', encoding='utf-8') as f:
+        predictions = json.load(f)
+    return write_corpus(predictions, corpus_path)
+
+
+def main(argv):
+    if len(argv) != 3:
+        print(f"Использование: python {argv[0]} <предсказания.json> <корпус.bin>")
+        return 2
+    count = convert_json(argv[1], argv[2])
+    print(f"Записано {count} предсказаний в {argv[2]}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
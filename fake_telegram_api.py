@@ -0,0 +1,173 @@
+"""Локальная заглушка Telegram Bot API для нагрузочных тестов без обращения к Telegram.
+
+Понимает getMe, sendMessage, getUpdates, setWebhook/deleteWebhook (прочие методы отвечают true),
+умеет добавлять задержку, ответы 429 с retry_after, временные ответы 502 (в PTB — NetworkError)
+и постоянные ошибки 403/400 с текстами, которые возвращает настоящий Bot API.
+
+Запуск отдельно:
+    python fake_telegram_api.py --port 8081 --latency-ms 50 --retry-after-rate 0.01 --error-rate 0.02
+и бот против него:
+    TELEGRAM_API_BASE_URL=http://127.0.0.1:8081/bot TELEGRAM_BOT_TOKEN=123:fake python bot.py
+"""
+import argparse
+import asyncio
+import collections
+import json
+import random
+import sys
+import time
+import urllib.parse
+
+# Ошибки, относящиеся к одному пользователю: бот удаляет его из рассылки и продолжает.
+# Ошибки канала ("bot was kicked", "chat not found", "have no rights") останавливают
+# всю рассылку, поэтому случайно их не выдаём.
+PERMANENT_ERRORS = (
+    (403, "Forbidden: bot was blocked by the user"),
+    (403, "Forbidden: user is deactivated"),
+    (400, "Bad Request: user not found"),
+    (400, "Bad Request: chat member not found"),
+)
+
+BOT_USER = {"id": 100000001, "is_bot": True, "first_name": "FakeBot", "username": "fake_predictor_bot"}
+
+
+class FakeBotApi:
+    """HTTP-сервер на asyncio, отвечающий как https://api.telegram.org/bot<token>/<method>."""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, retry_after_rate: float = 0.0,
+                 retry_after: int = 1, error_rate: float = 0.0, server_error_rate: float = 0.0, seed: int = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.server_error_rate = server_error_rate
+        self.rng = random.Random(seed)
+        self.stats = collections.Counter()
+        self.message_id = 0
+        self.server = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        self.server = await asyncio.start_server(self._handle_connection, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode('latin-1').partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                path = request_line.decode('latin-1').split()[1]
+                status, payload = await self._dispatch(path, headers.get("content-type", ""), body)
+                data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    "Content-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n\r\n".encode('latin-1') + data
+                )
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _parse_params(content_type: str, body: bytes) -> dict:
+        if not body:
+            return {}
+        if content_type.startswith("application/json"):
+            return json.loads(body)
+        return {key: values[-1] for key, values in urllib.parse.parse_qs(body.decode('utf-8')).items()}
+
+    async def _dispatch(self, path: str, content_type: str, body: bytes):
+        method = path.rstrip("/").rsplit("/", 1)[-1]
+        params = self._parse_params(content_type, body)
+        self.stats[f"requests:{method}"] += 1
+        if method == "getUpdates":
+            # Имитация long polling без апдейтов.
+            await asyncio.sleep(min(float(params.get("timeout", 0) or 0), 1.0))
+            return 200, {"ok": True, "result": []}
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter)))
+        if method == "getMe":
+            return 200, {"ok": True, "result": BOT_USER}
+        if method != "sendMessage":
+            return 200, {"ok": True, "result": True}
+
+        roll = self.rng.random()
+        if roll < self.retry_after_rate:
+            self.stats["sendMessage:429"] += 1
+            return 429, {
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }
+        roll -= self.retry_after_rate
+        if roll < self.error_rate:
+            code, description = self.rng.choice(PERMANENT_ERRORS)
+            self.stats[f"sendMessage:{code}"] += 1
+            return code, {"ok": False, "error_code": code, "description": description}
+        roll -= self.error_rate
+        if roll < self.server_error_rate:
+            self.stats["sendMessage:502"] += 1
+            return 502, {"ok": False, "error_code": 502, "description": "Bad Gateway"}
+
+        self.message_id += 1
+        self.stats["sendMessage:200"] += 1
+        return 200, {"ok": True, "result": {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(params.get("chat_id", 0)), "type": "supergroup", "title": "Fake chat"},
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }}
+
+
+async def serve(args):
+    api = FakeBotApi(args.latency_ms / 1000, args.jitter_ms / 1000, args.retry_after_rate,
+                     args.retry_after, args.error_rate, args.server_error_rate, args.seed)
+    port = await api.start(args.host, args.port)
+    print(f"Fake Bot API: http://{args.host}:{port}/bot<token>/<method>", flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        # Последняя строка вывода — статистика ответов; её читает bench.py.
+        print(json.dumps(api.stats), flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081, help="0 — выбрать свободный порт")
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--retry-after-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответах 429, секунды")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля постоянных ошибок (403/400)")
+    parser.add_argument("--server-error-rate", type=float, default=0.0, help="доля временных ошибок (502)")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,58 @@
+"""Отправляет записанные апдейты Telegram (JSON) на локальный вебхук бота.
+
+Бот запускается в режиме вебхука, например:
+    WEBHOOK_URL=https://example.com WEBHOOK_SECRET_TOKEN=secret WEBHOOK_PORT=8443 python bot.py
+
+Затем:
+    WEBHOOK_SECRET_TOKEN=secret python post_update.py update.json [ещё.json ...]
+
+Файл может содержать один апдейт или массив апдейтов.
+"""
+import argparse
+import json
+import os
+import sys
+import urllib.error
+import urllib.request
+
+
+def post_update(url, secret_token, update):
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(update, ensure_ascii=False).encode('utf-8'),
+        headers={
+            "Content-Type": "application/json",
+            "X-Telegram-Bot-Api-Secret-Token": secret_token or "",
+        },
+        method="POST",
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="+", help="JSON-файлы с апдейтами")
+    parser.add_argument(
+        "--url",
+        default=f"http://127.0.0.1:{os.getenv('WEBHOOK_PORT', '8443')}/{os.getenv('WEBHOOK_PATH', 'telegram')}"
+    )
+    parser.add_argument("--secret", default=os.getenv("WEBHOOK_SECRET_TOKEN"))
+    args = parser.parse_args()
+
+    failed = 0
+    for filename in args.files:
+        with open(filename, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        for update in data if isinstance(data, list) else [data]:
+            status = post_update(args.url, args.secret, update)
+            print(f"{filename}: update_id={update.get('update_id')} -> HTTP {status}")
+            failed += status != 200
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())